@@ -0,0 +1,95 @@
+import os
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from downloader import resolve_query
+
+# Searches allowed to run at the same time
+RESOLVE_WORKERS = int(os.getenv("RESOLVE_WORKERS", "4"))
+# Searches started per second at most, so a big playlist doesn't get us throttled by YouTube
+RESOLVE_RATE = float(os.getenv("RESOLVE_RATE", "2"))
+
+
+class RateLimiter:
+    """Token bucket: allows rate acquisitions per second with bursts of up to burst"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BatchResolver:
+    """Resolves queued Spotify tracks to YouTube videos in the background.
+
+    Tracks are searched in the order they were queued, a few at a time and
+    under a rate limit. Results land in the resolution cache, so by the time a
+    track reaches the head of the queue its download can skip the search.
+    """
+
+    def __init__(self, workers=RESOLVE_WORKERS, rate=RESOLVE_RATE):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="resolve")
+        self._limiter = RateLimiter(rate)
+        self._pending = deque()  # (owner, query, track)
+        self._wakeup = None
+        self._tasks = []
+
+    def submit(self, tracks, query_for, owner=None):
+        """Queue parsed Spotify tracks for resolution, query_for(track) gives the search text"""
+        self._start()
+        for track in tracks:
+            self._pending.append((owner, query_for(track), track))
+        self._wakeup.set()
+
+    def drop(self, owner):
+        """Forget the owner's tracks that haven't been searched yet (e.g. on /stop)"""
+        self._pending = deque(job for job in self._pending if job[0] != owner)
+
+    def pending(self):
+        return len(self._pending)
+
+    def _start(self):
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            _owner, query, track = self._pending.popleft()
+
+            def take_token():
+                # Runs on the executor thread, once per YouTube search; cached tracks take none
+                asyncio.run_coroutine_threadsafe(self._limiter.acquire(), loop).result()
+
+            # The resolution cache is checked on the executor too, it's a SQLite read
+            try:
+                await loop.run_in_executor(
+                    self._executor, lambda: resolve_query(
+                        query, duration_ms=track.get('duration_ms'), isrc=track.get('isrc'),
+                        before_search=take_token,
+                    ),
+                )
+            except Exception as e:
+                print(f"Background resolve failed for {query}: {e}")
@@ -0,0 +1,270 @@
+"""Offline stand-ins for yt-dlp, Spotify and Discord voice used by the benchmarks.
+
+install() puts fake ``yt_dlp``, ``spotipy``, ``requests`` and ``discord``
+modules into sys.modules before any bot module is imported, so nothing in a
+benchmark run touches the network. Latencies are configurable through
+FakeConfig.
+"""
+import sys
+import time
+import types
+import struct
+import hashlib
+import threading
+from dataclasses import dataclass
+
+
+@dataclass
+class FakeConfig:
+    search_latency: float = 0.05     # seconds per YouTube search
+    download_latency: float = 0.2    # seconds per download (including transcode)
+    spotify_latency: float = 0.05    # seconds per Spotify API request
+    song_packets: int = 3000         # 20 ms Opus packets per fake song (3000 = 1 minute, outlasts the downloads)
+    time_scale: float = 0.05         # how fast fake voice clients play compared to real time
+
+
+config = FakeConfig()
+
+
+# --- Ogg Opus ---------------------------------------------------------------
+
+def _ogg_page(packets, sequence):
+    lacing = b''
+    body = b''
+    for packet in packets:
+        size = len(packet)
+        while size >= 255:
+            lacing += b'\xff'
+            size -= 255
+        lacing += bytes([size])
+        body += packet
+    header = struct.pack('<4sBBqIIIB', b'OggS', 0, 0, 0, 1, sequence, 0, len(lacing))
+    return header + lacing + body
+
+
+def ogg_opus_bytes(packets):
+    """A minimal Ogg Opus file with `packets` 20 ms CELT frames (enough for OggOpusSource)"""
+    head = b'OpusHead' + bytes([1, 2]) + struct.pack('<HIhB', 312, 48000, 0, 0)
+    tags = b'OpusTags' + struct.pack('<I', 4) + b'fake' + struct.pack('<I', 0)
+    frames = [bytes([0xFC]) + bytes(120) for _ in range(packets)]
+    pages = [_ogg_page([head], 0), _ogg_page([tags], 1)]
+    for i in range(0, len(frames), 50):
+        pages.append(_ogg_page(frames[i:i + 50], 2 + i // 50))
+    return b''.join(pages)
+
+
+# --- yt_dlp -----------------------------------------------------------------
+
+class DownloadCancelled(Exception):
+    pass
+
+
+def _video_id(text):
+    return hashlib.md5(text.encode()).hexdigest()[:11]
+
+
+class FakeYoutubeDL:
+    searches = 0
+    downloads = 0
+    _count_lock = threading.Lock()
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url, download=False):
+        if url.startswith('ytsearch'):
+            prefix, _, query = url.partition(':')
+            count = int(prefix[len('ytsearch'):] or 1)
+            time.sleep(config.search_latency)
+            with self._count_lock:
+                FakeYoutubeDL.searches += 1
+            entries = [
+                {'id': _video_id(f"{query}#{rank}"), 'title': f"{query} (result {rank})", 'duration': 180 + rank}
+                for rank in range(count)
+            ]
+            return {'entries': entries}
+
+        video_id = url.rsplit('=', 1)[-1]
+        info = {'id': video_id, 'title': f"video {video_id}", 'duration': 180,
+                'url': f"https://media.invalid/{video_id}", 'http_headers': {}}
+        if not download:
+            return info
+
+        time.sleep(config.download_latency)
+        for hook in self.params.get('progress_hooks', []):
+            hook({'status': 'finished'})
+        path = self.params['outtmpl'].replace('%(ext)s', 'opus')
+        with open(path, 'wb') as f:
+            f.write(ogg_opus_bytes(config.song_packets))
+        for hook in self.params.get('postprocessor_hooks', []):
+            hook({'status': 'started', 'postprocessor': 'ExtractAudio'})
+            hook({'status': 'finished', 'postprocessor': 'ExtractAudio'})
+        with self._count_lock:
+            FakeYoutubeDL.downloads += 1
+        return info
+
+
+# --- spotipy ----------------------------------------------------------------
+
+class FakeSpotify:
+    """Serves synthetic playlists; the playlist id decides its size, e.g. "bench-5000" has 5000 tracks"""
+
+    requests = 0
+    _count_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def _request(self):
+        time.sleep(config.spotify_latency)
+        with self._count_lock:
+            FakeSpotify.requests += 1
+
+    @staticmethod
+    def _size(playlist_id):
+        return int(playlist_id.rsplit('-', 1)[-1])
+
+    def playlist(self, playlist_id, fields=None, **kwargs):
+        self._request()
+        return {'name': f"Playlist {playlist_id}", 'snapshot_id': f"snapshot-{playlist_id}"}
+
+    def playlist_tracks(self, playlist_id, limit=100, offset=0, **kwargs):
+        self._request()
+        total = self._size(playlist_id)
+        items = [
+            {'track': {
+                'name': f"Track {i}",
+                'artists': [{'name': f"Artist {i % 97}"}],
+                'duration_ms': 180000 + i,
+                'external_ids': {'isrc': f"BENCH{i:07d}"},
+            }}
+            for i in range(offset, min(offset + limit, total))
+        ]
+        return {'items': items, 'total': total, 'next': None}
+
+
+# --- discord ----------------------------------------------------------------
+
+class AudioSource:
+    def read(self):
+        raise NotImplementedError
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        pass
+
+
+class FFmpegPCMAudio(AudioSource):
+    """Pretends to be FFmpeg: yields one silent 20 ms PCM frame per packet of a fake song"""
+
+    def __init__(self, source, **kwargs):
+        self.source = source
+        self._remaining = config.song_packets
+
+    def read(self):
+        if self._remaining <= 0:
+            return b''
+        self._remaining -= 1
+        return bytes(3840)
+
+
+class FakeVoiceClient:
+    """Plays sources on a thread like discord.py, time-compressed by config.time_scale"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self._connected = True
+        self._active = False
+        self._stop = threading.Event()
+        self._paused = False
+        self.packets_sent = 0
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._active and not self._paused
+
+    def is_paused(self):
+        return self._active and self._paused
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    def play(self, source, after=None):
+        if self.is_playing():
+            raise RuntimeError("Already playing audio.")
+        self._stop = threading.Event()
+        stop = self._stop
+
+        def run():
+            delay = 0.02 * config.time_scale
+            while not stop.is_set():
+                if not source.read():
+                    break
+                self.packets_sent += 1
+                if delay:
+                    stop.wait(delay)
+            # Like discord.py, the client no longer counts as playing when after() runs
+            self._active = False
+            source.cleanup()
+            if after:
+                after(None)
+
+        self._active = True
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self._connected = False
+
+
+class FakeVoiceChannel:
+    def __init__(self, name):
+        self.name = name
+        self.members = [object(), object()]
+
+    async def connect(self, **kwargs):
+        return FakeVoiceClient(self)
+
+
+# --- installation -----------------------------------------------------------
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install():
+    """Register the fake modules; must run before importing any bot module"""
+    yt_dlp = _module('yt_dlp', YoutubeDL=FakeYoutubeDL)
+    yt_dlp.utils = _module('yt_dlp.utils', DownloadCancelled=DownloadCancelled)
+
+    spotipy = _module('spotipy', Spotify=FakeSpotify)
+    spotipy.cache_handler = _module('spotipy.cache_handler', CacheFileHandler=lambda **kwargs: None)
+    spotipy.oauth2 = _module('spotipy.oauth2', SpotifyClientCredentials=lambda **kwargs: None)
+
+    class Session:
+        def mount(self, prefix, adapter):
+            pass
+
+    requests = _module('requests', Session=Session)
+    requests.adapters = _module('requests.adapters', HTTPAdapter=lambda **kwargs: None)
+
+    _module('discord', AudioSource=AudioSource, FFmpegPCMAudio=FFmpegPCMAudio)
@@ -0,0 +1,283 @@
+"""Offline performance benchmarks for the music bot.
+
+Runs against the fakes in benchmarks/fakes.py, so no Discord token, Spotify
+credentials, network or FFmpeg are needed:
+
+    python benchmarks/run.py --output bench.json
+
+Results are printed to stdout (and optionally written to a file) as JSON so
+runs can be compared over time; the bot's own logging goes to stderr.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import contextlib
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fakes  # noqa: E402
+
+
+def timed(func, *args, repeat=5, setup=None):
+    """Best and median wall time of func over repeat runs, in seconds.
+
+    setup, if given, runs before each run outside the timed region and its
+    result is passed to func.
+    """
+    runs = []
+    for _ in range(repeat):
+        call_args = (setup(),) + args if setup else args
+        start = time.perf_counter()
+        func(*call_args)
+        runs.append(time.perf_counter() - start)
+    return {'best_s': min(runs), 'median_s': statistics.median(runs)}
+
+
+async def bench_queue(size):
+    """TrackQueue operations on a large queue, next to the old drain-and-refill read"""
+    from track_queue import TrackQueue
+
+    items = [f"Track {i} - Artist {i % 97}" for i in range(size)]
+
+    def fill():
+        queue = TrackQueue()
+        queue.extend(items)
+        return queue
+
+    def push_pop():
+        queue = TrackQueue()
+        for item in items:
+            queue.put(item)
+        while queue:
+            queue.pop()
+
+    queue = fill()
+    results = {
+        'size': size,
+        'push_pop_all': timed(push_pop),
+        'peek_10': timed(lambda: [queue.peek(10) for _ in range(1000)]),
+        'iterate': timed(lambda: sum(1 for _ in queue)),
+        'jump_to_middle': timed(lambda queue: queue.jump_to(size // 2), setup=fill),
+        'remove_middle': timed(lambda queue: queue.remove_at(size // 2), setup=fill),
+    }
+    results['peek_10']['per_call_s'] = results['peek_10']['median_s'] / 1000
+
+    # Baseline: what get_queue_list cost with asyncio.Queue
+    legacy = asyncio.Queue()
+    for item in items:
+        legacy.put_nowait(item)
+    runs = []
+    for _ in range(5):
+        start = time.perf_counter()
+        drained = []
+        while not legacy.empty():
+            drained.append(legacy.get_nowait())
+        for item in drained:
+            await legacy.put(item)
+        runs.append(time.perf_counter() - start)
+    results['legacy_drain_refill'] = {'best_s': min(runs), 'median_s': statistics.median(runs)}
+    return results
+
+
+async def bench_playlist_ingest(size):
+    """Time to the first page and to the whole playlist, cold and with a warm snapshot cache"""
+    import spotify_utils
+
+    spotify_utils._client = fakes.FakeSpotify()
+    url = f"https://open.spotify.com/playlist/bench-{size}"
+    results = {'tracks': size}
+
+    for label in ('cold', 'warm'):
+        requests_before = fakes.FakeSpotify.requests
+        start = time.perf_counter()
+        first_page = None
+        count = 0
+        async for page in spotify_utils.stream_playlist(url):
+            if first_page is None:
+                first_page = time.perf_counter() - start
+            count += len(page)
+        results[label] = {
+            'first_page_s': first_page,
+            'total_s': time.perf_counter() - start,
+            'tracks_loaded': count,
+            'spotify_requests': fakes.FakeSpotify.requests - requests_before,
+        }
+
+    requests_before = fakes.FakeSpotify.requests
+    start = time.perf_counter()
+    await asyncio.to_thread(spotify_utils.get_playlist_stats, url)
+    results['stats_after_ingest'] = {
+        'total_s': time.perf_counter() - start,
+        'spotify_requests': fakes.FakeSpotify.requests - requests_before,
+    }
+    return results
+
+
+async def bench_cache_lookup(entries):
+    """Cache index and download_song cache-hit throughput"""
+    import downloader
+    from cache_index import CacheIndex
+
+    index = CacheIndex(os.path.join(downloader.DOWNLOAD_FOLDER, "bench-index.sqlite3"))
+    path = os.path.join(downloader.DOWNLOAD_FOLDER, "bench.opus")
+    with open(path, 'wb') as f:
+        f.write(fakes.ogg_opus_bytes(10))
+    for i in range(entries):
+        index.record(f"key{i}", path)
+
+    lookups = 10000
+    start = time.perf_counter()
+    for i in range(lookups):
+        index.lookup(f"key{(i * 7919) % entries}")
+    index_s = time.perf_counter() - start
+
+    queries = [f"Cached Song {i} - Artist" for i in range(200)]
+    for query in queries:
+        await asyncio.to_thread(downloader.download_song, query)
+    start = time.perf_counter()
+    for _ in range(5):
+        for query in queries:
+            downloader.download_song(query)
+    hit_s = time.perf_counter() - start
+
+    return {
+        'entries': entries,
+        'index_lookups_per_s': lookups / index_s,
+        'download_song_hits_per_s': len(queries) * 5 / hit_s,
+    }
+
+
+async def bench_soak(guilds, songs_per_guild, shared_songs):
+    """Many guilds playing at once with downloads, prefetching and playback on fake voice clients"""
+    import metrics
+    from batch_resolver import BatchResolver
+    from download_pool import DownloadPool
+    from player import PlayerRegistry, IDLE
+
+    registry = PlayerRegistry(DownloadPool(), BatchResolver())
+    searches_before = fakes.FakeYoutubeDL.searches
+    downloads_before = fakes.FakeYoutubeDL.downloads
+
+    # Measure how late the event loop runs a 10 ms ticker while everything plays
+    lags = []
+    running = True
+
+    async def ticker():
+        while running:
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - start - 0.01)
+
+    ticker_task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+
+    players = []
+    for guild_id in range(guilds):
+        player = registry.get(guild_id)
+        await player.connect(fakes.FakeVoiceChannel(f"voice-{guild_id}"))
+        for i in range(songs_per_guild):
+            # Some songs are popular across guilds, the rest are unique
+            if i < shared_songs:
+                player.enqueue(f"Popular Song {i} - Artist")
+            else:
+                player.enqueue(f"Song {guild_id}-{i} - Artist")
+        players.append(player)
+
+    await asyncio.gather(*(player.play_next(time.monotonic()) for player in players))
+
+    while any(player.queue or player.state != IDLE for player in players):
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    running = False
+    await ticker_task
+
+    first_audio_count, first_audio_avg = metrics.FIRST_AUDIO_SECONDS.summary()
+    gap_count, gap_avg = metrics.TRACK_GAP_SECONDS.summary()
+    lags.sort()
+    return {
+        'guilds': guilds,
+        'songs_per_guild': songs_per_guild,
+        'total_s': elapsed,
+        'songs_per_s': guilds * songs_per_guild / elapsed,
+        'time_to_first_audio_avg_s': first_audio_avg,
+        'first_audio_samples': first_audio_count,
+        'track_gap_avg_s': gap_avg,
+        'track_gap_samples': gap_count,
+        'loop_lag_p50_s': lags[len(lags) // 2] if lags else 0,
+        'loop_lag_max_s': lags[-1] if lags else 0,
+        'searches': fakes.FakeYoutubeDL.searches - searches_before,
+        'downloads': fakes.FakeYoutubeDL.downloads - downloads_before,
+        'packets_sent': sum(player.voice_client.packets_sent for player in players),
+    }
+
+
+async def run_all(args):
+    return {
+        'queue': await bench_queue(args.queue_size),
+        'playlist_ingest': await bench_playlist_ingest(args.playlist_size),
+        'cache_lookup': await bench_cache_lookup(args.cache_entries),
+        'soak': await bench_soak(args.guilds, args.songs_per_guild, args.shared_songs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help="also write the JSON results to this file")
+    parser.add_argument('--queue-size', type=int, default=10000)
+    parser.add_argument('--playlist-size', type=int, default=5000)
+    parser.add_argument('--cache-entries', type=int, default=10000)
+    parser.add_argument('--guilds', type=int, default=50)
+    parser.add_argument('--songs-per-guild', type=int, default=5)
+    parser.add_argument('--shared-songs', type=int, default=2)
+    parser.add_argument('--search-latency', type=float, default=fakes.config.search_latency)
+    parser.add_argument('--download-latency', type=float, default=fakes.config.download_latency)
+    parser.add_argument('--spotify-latency', type=float, default=fakes.config.spotify_latency)
+    parser.add_argument('--song-packets', type=int, default=fakes.config.song_packets,
+                        help="length of a fake song in 20 ms packets")
+    parser.add_argument('--time-scale', type=float, default=fakes.config.time_scale,
+                        help="playback speed of fake voice clients relative to real time")
+    args = parser.parse_args()
+
+    fakes.config.search_latency = args.search_latency
+    fakes.config.download_latency = args.download_latency
+    fakes.config.spotify_latency = args.spotify_latency
+    fakes.config.song_packets = args.song_packets
+    fakes.config.time_scale = args.time_scale
+    fakes.install()
+
+    # Bot modules create songs/ and playlists/ in the working directory
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix="musicbot-bench-")
+    os.chdir(workdir)
+    os.environ.setdefault("METRICS_PORT", "0")
+    # The fakes don't produce real audio for FFmpeg to measure
+    os.environ.setdefault("LOUDNESS_NORMALIZATION", "0")
+
+    started = time.time()
+    # Keep the bot's own logging off stdout so stdout is pure JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        results = asyncio.run(run_all(args))
+    report = {
+        'started_at': started,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'results': results,
+    }
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
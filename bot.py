@@ -1,60 +1,37 @@
 import os
 import discord
 from discord.ext import commands, tasks
-from discord import app_commands, FFmpegPCMAudio
-from downloader import download_song
-from spotify_utils import get_tracks_from_playlist, get_playlist_stats
-from datetime import datetime, timedelta
+from discord import app_commands
+from download_pool import DownloadPool
+from downloader import cache_index, analyze_missing
+from credentials import get_credentials
+from player import PlayerRegistry, IDLE
+from batch_resolver import BatchResolver
+from sessions import SessionStore, SESSION_SAVE_INTERVAL
+import metrics
+from loop_monitor import watchdog, profiler
+from spotify_utils import stream_playlist, get_playlist_stats
 import asyncio
+import hashlib
+import io
+import json
 import sys
+import time
 
 DOWNLOAD_FOLDER = "songs"
 
+# Set by cluster.py when this process is one of several workers sharing the bot's shards
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))
+SHARD_IDS = [int(shard) for shard in os.getenv("SHARD_IDS", "").split(",") if shard.strip()]
+# Only worker 0 syncs slash commands and maintains the shared audio cache
+CLUSTER_WORKER = int(os.getenv("CLUSTER_WORKER", "0"))
+# Fingerprint of the last synced slash commands, delete it to force a sync
+COMMAND_HASH_FILE = ".commands.sha256"
+
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
-def get_credentials():
-    """
-    Try multiple methods to get credentials securely:
-    1. Environment variables
-    2. Command line arguments
-    3. Secure input prompts
-    """
-    import getpass
-    
-    credentials = {}
-    
-    discord_token = os.getenv("DISCORD_TOKEN")
-    if not discord_token and len(sys.argv) > 1:
-        discord_token = sys.argv[1]
-    if not discord_token:
-        print("Discord token not found in environment variables.")
-        discord_token = getpass.getpass("Please enter your Discord bot token: ")
-    
-    credentials['discord_token'] = discord_token
-    
-    spotify_client_id = os.getenv("SPOTIFY_CLIENT_ID")
-    spotify_client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
-    
-    if not spotify_client_id and len(sys.argv) > 2:
-        spotify_client_id = sys.argv[2]
-    if not spotify_client_secret and len(sys.argv) > 3:
-        spotify_client_secret = sys.argv[3]
-        
-    if not spotify_client_id:
-        print("Spotify Client ID not found in environment variables.")
-        spotify_client_id = getpass.getpass("Please enter your Spotify Client ID: ")
-    
-    if not spotify_client_secret:
-        print("Spotify Client Secret not found in environment variables.")
-        spotify_client_secret = getpass.getpass("Please enter your Spotify Client Secret: ")
-    
-    credentials['spotify_client_id'] = spotify_client_id
-    credentials['spotify_client_secret'] = spotify_client_secret
-    
-    return credentials
-
 CREDENTIALS = get_credentials()
 
 if not CREDENTIALS['discord_token']:
@@ -68,287 +45,240 @@ if not CREDENTIALS['spotify_client_id'] or not CREDENTIALS['spotify_client_secre
 os.environ['SPOTIFY_CLIENT_ID'] = CREDENTIALS['spotify_client_id']
 os.environ['SPOTIFY_CLIENT_SECRET'] = CREDENTIALS['spotify_client_secret']
 
-bot = commands.Bot(command_prefix="/", intents=intents)
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix="/", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None,
+    )
+else:
+    bot = commands.Bot(command_prefix="/", intents=intents)
 tree = bot.tree
-song_queue = asyncio.Queue()
-current_voice_client = None
-now_playing = None
-is_playing = False
-processing_queue = False
-
+download_pool = DownloadPool()
+resolver = BatchResolver()
+players = PlayerRegistry(download_pool, resolver)
+session_store = SessionStore()
+sessions_restored = False
+metrics_runner = None
+
+metrics.Gauge(
+    "musicbot_queue_depth", "Songs waiting in each guild's queue",
+    lambda: [({'guild': player.guild_id}, len(player.queue)) for player in players],
+)
+metrics.Gauge(
+    "musicbot_active_voice_clients", "Voice channels the bot is connected to",
+    lambda: sum(1 for player in players if player.is_connected()),
+)
+metrics.Gauge("musicbot_guild_players", "Guild players currently held in memory", lambda: len(players))
+metrics.Gauge("musicbot_resolve_backlog", "Queued songs waiting for a background search", lambda: resolver.pending())
+
+
+def command_fingerprint():
+    """Hash of the slash command definitions as they would be sent to Discord"""
+    commands_json = []
+    for command in tree.get_commands():
+        try:
+            commands_json.append(command.to_dict(tree))
+        except TypeError:  # discord.py before 2.4
+            commands_json.append(command.to_dict())
+    commands_json.sort(key=lambda command: command['name'])
+    payload = json.dumps({'application': bot.application_id, 'commands': commands_json}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
 
-@bot.event
-async def on_ready():
-    await tree.sync()
-    cleanup_old_files.start()
-    print(f"Logged in as {bot.user}")
 
+async def sync_commands():
+    """Sync the command tree with Discord only if the commands changed since the last sync"""
+    fingerprint = command_fingerprint()
+    try:
+        with open(COMMAND_HASH_FILE) as f:
+            if f.read().strip() == fingerprint:
+                print("Slash commands unchanged, skipping sync")
+                return
+    except OSError:
+        pass
 
-async def get_queue_list():
-    """Helper function to get current queue as a list without emptying it"""
-    queue_list = []
-    temp_queue = []
-    
-    while not song_queue.empty():
-        try:
-            item = song_queue.get_nowait()
-            temp_queue.append(item)
-            queue_list.append(item)
-        except asyncio.QueueEmpty:
-            break
-    
-    for item in temp_queue:
-        await song_queue.put(item)
-    
-    return queue_list
+    try:
+        await tree.sync()
+    except discord.HTTPException as e:
+        # Runs from setup_hook, raising would stop the bot from logging in; the next start tries again
+        print(f"Failed to sync commands: {e}")
+        return
+    print("Slash commands synced")
 
+    temp_path = f"{COMMAND_HASH_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "w") as f:
+            f.write(fingerprint)
+        os.replace(temp_path, COMMAND_HASH_FILE)
+    except OSError as e:
+        print(f"Could not save the command fingerprint, commands will sync again next start: {e}")
 
-async def skip_to_song(target_song, interaction):
-    """Skip songs in queue until we reach the target song"""
-    queue_list = await get_queue_list()
-    
-    # Find the target song
-    target_index = -1
-    
-    # Try to find by exact name match first
-    for i, song in enumerate(queue_list):
-        if song.lower() == target_song.lower():
-            target_index = i
-            break
-    
-    # If not found, try partial match
-    if target_index == -1:
-        for i, song in enumerate(queue_list):
-            if target_song.lower() in song.lower():
-                target_index = i
-                break
-    
-    # If still not found, try by position number
-    if target_index == -1:
-        try:
-            pos = int(target_song) - 1
-            if 0 <= pos < len(queue_list):
-                target_index = pos
-        except ValueError:
-            pass
-    
-    if target_index == -1:
-        return False, "Song not found in queue"
-    
-    # Remove songs before the target
-    for _ in range(target_index):
-        try:
-            song_queue.get_nowait()
-        except asyncio.QueueEmpty:
-            break
-    
-    # Stop current song to trigger next
-    if current_voice_client and (current_voice_client.is_playing() or current_voice_client.is_paused()):
-        current_voice_client.stop()
-    
-    return True, f"Skipping to: {queue_list[target_index]}"
 
+async def setup_hook():
+    # Runs once per process after login, unlike on_ready which fires again on every reconnect
+    global metrics_runner
+    watchdog.start()
+    metrics_runner = await metrics.start_http_server()
+    if CLUSTER_WORKER == 0:
+        await sync_commands()
+        maintain_audio_cache.start()
+    reap_idle_players.start()
+    save_sessions.start()
 
-async def play_next_song(interaction):
-    global now_playing, is_playing, current_voice_client, processing_queue
+bot.setup_hook = setup_hook
 
-    if processing_queue:
-        print("Already processing queue, ignoring duplicate call")
-        return
-    
-    if song_queue.empty():
-        now_playing = None
-        is_playing = False
-        print("Queue empty, stopping playback")
-        return
 
+async def close():
+    # Save where every guild was before shutting down, so the next start resumes from there
     try:
-        query = await song_queue.get()
-        print(f"Got from queue: {query}")
-        
-        processing_queue = True
-        
-        if not current_voice_client or not current_voice_client.is_connected():
-            if interaction.user.voice and interaction.user.voice.channel:
-                print(f"Connecting to voice channel: {interaction.user.voice.channel.name}")
-                current_voice_client = await interaction.user.voice.channel.connect()
-            else:
-                print("User not in voice channel")
-                processing_queue = False
-                return
-
-        print(f"Starting download: {query}")
-        mp3_path = download_song(query)
-        print(f"Download result: {mp3_path}")
-        
-        if not mp3_path:
-            print(f"Download failed (None returned): {query}")
-            processing_queue = False
-            await play_next_song(interaction)
-            return
-            
-        if not os.path.exists(mp3_path):
-            print(f"File doesn't exist: {mp3_path}")
-            processing_queue = False
-            await play_next_song(interaction)
-            return
-
-        file_size = os.path.getsize(mp3_path)
-        print(f"File ready: {mp3_path} ({file_size} bytes)")
-        
-        if file_size < 1000:
-            print(f"File too small, probably corrupted: {file_size} bytes")
-            processing_queue = False
-            await play_next_song(interaction)
-            return
+        await session_store.save(players)
+    except Exception as e:
+        print(f"Could not save sessions on shutdown: {e}")
+    await type(bot).close(bot)
+
+bot.close = close
+
+
+async def restore_sessions():
+    """Rejoin the voice channels and queues saved before the last shutdown or crash"""
+    restored = 0
+    for session in await asyncio.to_thread(session_store.load):
+        guild = bot.get_guild(int(session['guild_id']))
+        if guild is None:
+            # Not in this guild anymore, or another cluster worker's shard has it
+            continue
+        channel = guild.get_channel(session['voice_channel_id'])
+        if channel is None or not any(not member.bot for member in channel.members):
+            session_store.forget(guild.id)
+            continue
+
+        player = players.get(guild.id)
+        if session['text_channel_id']:
+            player.text_channel = guild.get_channel(session['text_channel_id'])
+        # Guilds reconnect and start playing in parallel instead of one after another
+        asyncio.create_task(restore_session(player, channel, session))
+        restored += 1
+    if restored:
+        print(f"Restoring {restored} sessions")
+
+
+async def restore_session(player, channel, session):
+    """Rejoin one guild's voice channel and continue its saved queue"""
+    try:
+        await player.restore(channel, session['now_playing'], session['queue'], session['position'])
+    except Exception as e:
+        player.log(f"Could not rejoin {channel.name}: {e}")
 
-        if not current_voice_client or not current_voice_client.is_connected():
-            print("Voice client disconnected during download")
-            processing_queue = False
-            return
 
-        if current_voice_client.is_playing():
-            print("Stopping current audio")
-            current_voice_client.stop()
+@bot.event
+async def on_ready():
+    global sessions_restored
+    if not sessions_restored:
+        sessions_restored = True
+        await restore_sessions()
+    if SHARD_COUNT:
+        print(f"Logged in as {bot.user} (worker {CLUSTER_WORKER}, shards {SHARD_IDS or 'all'} of {SHARD_COUNT})")
+    else:
+        print(f"Logged in as {bot.user}")
 
-        now_playing = query
-        is_playing = True
-        
-        print(f"Starting playback: {query}")
-        
-        ffmpeg_options = {
-            'options': '-vn'
-        }
-        
-        def after_playing(error):
-            global is_playing, processing_queue
-            print(f"after_playing called for: {query}")
-            
-            if error:
-                print(f"Playback error: {error}")
-            else:
-                print(f"Finished playing: {query}")
-            
-            is_playing = False
-            processing_queue = False
-            
-            def schedule_next():
-                asyncio.run_coroutine_threadsafe(play_next_song(interaction), bot.loop)
-            
-            bot.loop.call_later(0.5, schedule_next)
 
-        try:
-            audio_source = FFmpegPCMAudio(mp3_path, **ffmpeg_options)
-            print(f"Audio source created for: {query}")
-            
-            current_voice_client.play(audio_source, after=after_playing)
-            print(f"Playback started: {query}")
-            
-            try:
-                if hasattr(interaction, 'followup'):
-                    await interaction.followup.send(f"Now playing: **{query}**")
-                elif hasattr(interaction, 'channel') and interaction.channel:
-                    await interaction.channel.send(f"Now playing: **{query}**")
-            except Exception as msg_error:
-                print(f"Could not send message: {msg_error}")
-                
-        except Exception as play_error:
-            print(f"Error starting playback: {play_error}")
-            is_playing = False
-            processing_queue = False
-            await play_next_song(interaction)
-            
-    except Exception as e:
-        print(f"Major error in play_next_song: {e}")
-        import traceback
-        traceback.print_exc()
-        processing_queue = False
-        is_playing = False
+def get_player(interaction):
+    """Return the guild's player, remembering where to post its messages"""
+    player = players.get(interaction.guild_id)
+    if interaction.channel:
+        player.text_channel = interaction.channel
+    return player
 
 
 @tree.command(name="play", description="Play a song from YouTube or Spotify")
 @app_commands.describe(query="Name of the song or Spotify track")
+@app_commands.guild_only()
 async def play(interaction: discord.Interaction, query: str):
-    global current_voice_client, is_playing
-
+    requested_at = time.monotonic()
     await interaction.response.defer()
     user = interaction.user
+    player = get_player(interaction)
 
     if not user.voice or not user.voice.channel:
         await interaction.followup.send("Join a voice channel first.")
         return
 
-    if not current_voice_client or not current_voice_client.is_connected():
-        try:
-            current_voice_client = await user.voice.channel.connect()
-            print(f"Connected to {user.voice.channel.name}")
-        except Exception as e:
-            await interaction.followup.send(f"Failed to connect to voice channel: {e}")
-            return
+    try:
+        await player.connect(user.voice.channel)
+    except Exception as e:
+        await interaction.followup.send(f"Failed to connect to voice channel: {e}")
+        return
 
-    await song_queue.put(query)
-    queue_size = song_queue.qsize()
+    queue_size = player.enqueue(query)
     
-    if queue_size == 1 and not is_playing:
+    if queue_size == 1 and player.state == IDLE:
         await interaction.followup.send(f"Playing: **{query}**")
-        await play_next_song(interaction)
+        await player.play_next(requested_at)
     else:
         await interaction.followup.send(f"Queued: **{query}** (Position: {queue_size})")
 
 
 @tree.command(name="playlist", description="Queue all songs in a Spotify playlist")
 @app_commands.describe(url="Full Spotify playlist URL")
+@app_commands.guild_only()
 async def playlist(interaction: discord.Interaction, url: str):
+    requested_at = time.monotonic()
     await interaction.response.defer()
     user = interaction.user
+    player = get_player(interaction)
 
     if not user.voice or not user.voice.channel:
         await interaction.followup.send("Join a voice channel first.")
         return
 
+    # Connected before anything is queued, so prefetches use the channel's encoding profile
+    try:
+        await player.connect(user.voice.channel)
+    except Exception as e:
+        await interaction.followup.send(f"Failed to connect to voice channel: {e}")
+        return
+
+    pages = stream_playlist(url, owner=interaction.guild_id)
     try:
-        tracks = get_tracks_from_playlist(url)
+        # Start playing as soon as the first page is in, the rest is queued in the background
+        tracks = await anext(pages, None)
         if not tracks:
+            await pages.aclose()
             await interaction.followup.send("No tracks found in playlist.")
             return
 
-        for track in tracks:
-            await song_queue.put(track)
+        player.enqueue_tracks(tracks)
 
         await interaction.followup.send(f"Queued {len(tracks)} songs from playlist. Starting playback...")
 
-        global current_voice_client, is_playing
-        
-        if not current_voice_client or not current_voice_client.is_connected():
-            current_voice_client = await user.voice.channel.connect()
+        player.start_ingest(pages)
 
-        if not is_playing:
-            await play_next_song(interaction)
+        if player.state == IDLE:
+            await player.play_next(requested_at)
             
     except Exception as e:
+        await pages.aclose()
         await interaction.followup.send(f"Error loading playlist: {e}")
 
 
 @tree.command(name="skipto", description="Skip to a specific song in the queue")
 @app_commands.describe(song="Song name or position number to skip to")
+@app_commands.guild_only()
 async def skipto(interaction: discord.Interaction, song: str = None):
     await interaction.response.defer()
+    player = get_player(interaction)
     
-    queue_list = await get_queue_list()
-    
-    if not queue_list and not now_playing:
+    if not player.queue and not player.now_playing:
         await interaction.followup.send("Queue is empty.")
         return
     
     # If no song specified, show the queue
     if not song:
         message = "**Current Queue:**\n"
-        if now_playing:
-            message += f"**Now Playing:** {now_playing}\n\n"
+        if player.now_playing:
+            message += f"**Now Playing:** {player.now_playing}\n\n"
         
-        if queue_list:
+        if player.queue:
             message += "**Up Next:**\n"
-            for i, track in enumerate(queue_list, 1):
+            for i, track in enumerate(player.queue, 1):
                 message += f"{i}. {track}\n"
             message += "\nUse `/skipto <song name or number>` to skip to a specific song."
         else:
@@ -358,7 +288,7 @@ async def skipto(interaction: discord.Interaction, song: str = None):
         return
     
     # Skip to the specified song
-    success, result_message = await skip_to_song(song, interaction)
+    success, result_message = player.skip_to(song)
     
     if success:
         await interaction.followup.send(result_message)
@@ -366,94 +296,89 @@ async def skipto(interaction: discord.Interaction, song: str = None):
         await interaction.followup.send(f"Error: {result_message}")
 
 
+@skipto.autocomplete("song")
+async def skipto_autocomplete(interaction: discord.Interaction, current: str):
+    player = players.find(interaction.guild_id)
+    if not player or not player.queue:
+        return []
+    if current.strip():
+        matches = player.queue.search(current, limit=25)
+    else:
+        matches = list(enumerate(player.queue.peek(25)))
+    # Discord allows 25 choices of at most 100 characters
+    return [
+        app_commands.Choice(name=f"{position + 1}. {track}"[:100], value=track[:100])
+        for position, track in matches
+    ]
+
+
 @tree.command(name="pause", description="Pause the current song")
+@app_commands.guild_only()
 async def pause(interaction: discord.Interaction):
-    if current_voice_client and current_voice_client.is_playing():
-        current_voice_client.pause()
+    if get_player(interaction).pause():
         await interaction.response.send_message("Paused.")
     else:
         await interaction.response.send_message("Nothing is playing.")
 
 
 @tree.command(name="resume", description="Resume the paused song")
+@app_commands.guild_only()
 async def resume(interaction: discord.Interaction):
-    if current_voice_client and current_voice_client.is_paused():
-        current_voice_client.resume()
+    if get_player(interaction).resume():
         await interaction.response.send_message("Resumed.")
     else:
         await interaction.response.send_message("Nothing is paused.")
 
 
 @tree.command(name="skip", description="Skip the current song")
+@app_commands.guild_only()
 async def skip(interaction: discord.Interaction):
-    if current_voice_client and (current_voice_client.is_playing() or current_voice_client.is_paused()):
-        current_voice_client.stop()
+    if get_player(interaction).skip():
         await interaction.response.send_message("Skipped.")
     else:
         await interaction.response.send_message("Nothing to skip.")
 
 
 @tree.command(name="stop", description="Stop playing and clear the queue")
+@app_commands.guild_only()
 async def stop(interaction: discord.Interaction):
-    global is_playing, now_playing, processing_queue
-    
-    while not song_queue.empty():
-        try:
-            song_queue.get_nowait()
-        except asyncio.QueueEmpty:
-            break
-    
-    if current_voice_client:
-        if current_voice_client.is_playing() or current_voice_client.is_paused():
-            current_voice_client.stop()
-        
-    is_playing = False
-    now_playing = None
-    processing_queue = False
+    get_player(interaction).stop()
     await interaction.response.send_message("Stopped and cleared queue.")
 
 
 @tree.command(name="disconnect", description="Disconnect from voice channel")
+@app_commands.guild_only()
 async def disconnect(interaction: discord.Interaction):
-    global current_voice_client, is_playing, now_playing, processing_queue
+    player = get_player(interaction)
     
-    if current_voice_client:
-        await current_voice_client.disconnect()
-        current_voice_client = None
-        is_playing = False
-        now_playing = None
-        processing_queue = False
-        
-        while not song_queue.empty():
-            try:
-                song_queue.get_nowait()
-            except asyncio.QueueEmpty:
-                break
-                
+    if player.voice_client:
+        await player.disconnect()
         await interaction.response.send_message("Disconnected from voice channel.")
     else:
         await interaction.response.send_message("Not connected to a voice channel.")
 
 
 @tree.command(name="queue", description="Show the current queue")
+@app_commands.guild_only()
 async def show_queue(interaction: discord.Interaction):
-    queue_list = await get_queue_list()
+    player = get_player(interaction)
+    queue_size = len(player.queue)
     
-    if not queue_list and not now_playing:
+    if not queue_size and not player.now_playing:
         await interaction.response.send_message("Queue is empty.")
         return
     
     message = "**Current Queue:**\n"
-    if now_playing:
-        message += f"**Now Playing:** {now_playing}\n\n"
+    if player.now_playing:
+        message += f"**Now Playing:** {player.now_playing}\n\n"
     
-    if queue_list:
+    if queue_size:
         message += "**Up Next:**\n"
-        for i, song in enumerate(queue_list[:10], 1):
+        for i, song in enumerate(player.queue.peek(10), 1):
             message += f"{i}. {song}\n"
         
-        if len(queue_list) > 10:
-            message += f"... and {len(queue_list) - 10} more songs"
+        if queue_size > 10:
+            message += f"... and {queue_size - 10} more songs"
     else:
         message += "No songs in queue."
     
@@ -465,7 +390,8 @@ async def show_queue(interaction: discord.Interaction):
 async def stats(interaction: discord.Interaction, url: str):
     await interaction.response.defer()
     try:
-        stats = get_playlist_stats(url)
+        # On a worker thread, waiting for Spotify must not block the other guilds
+        stats = await asyncio.to_thread(get_playlist_stats, url, interaction.guild_id)
         await interaction.followup.send(
             f"**Playlist Stats**:\n"
             f"**{stats['name']}**\n"
@@ -477,28 +403,86 @@ async def stats(interaction: discord.Interaction, url: str):
         await interaction.followup.send(f"Error: {e}")
 
 
-@tasks.loop(hours=24)
-async def cleanup_old_files():
-    now = datetime.now()
-    for filename in os.listdir(DOWNLOAD_FOLDER):
-        file_path = os.path.join(DOWNLOAD_FOLDER, filename)
-        if os.path.isfile(file_path):
-            modified = datetime.fromtimestamp(os.path.getmtime(file_path))
-            if now - modified > timedelta(days=30):
-                os.remove(file_path)
-                print(f"Deleted old file: {filename}")
+@tree.command(name="metrics", description="Show playback performance metrics")
+@app_commands.default_permissions(administrator=True)
+async def show_metrics(interaction: discord.Interaction):
+    hits = metrics.CACHE_LOOKUPS.value(result="hit")
+    lookups = hits + metrics.CACHE_LOOKUPS.value(result="miss")
+    queued = sum(len(player.queue) for player in players)
+    voice_clients = sum(1 for player in players if player.is_connected())
+
+    message = "**Playback Metrics:**\n"
+    for label, histogram in (
+        ("Search", metrics.SEARCH_SECONDS),
+        ("Download", metrics.DOWNLOAD_SECONDS),
+        ("Transcode", metrics.TRANSCODE_SECONDS),
+        ("Time to first audio", metrics.FIRST_AUDIO_SECONDS),
+        ("Gap between songs", metrics.TRACK_GAP_SECONDS),
+    ):
+        count, average = histogram.summary()
+        message += f"- {label}: {average:.2f}s avg over {count}\n"
+    message += f"- Cache hit ratio: {hits / lookups:.0%} of {lookups} lookups\n" if lookups else "- Cache hit ratio: no lookups yet\n"
+    message += f"- Active voice clients: {voice_clients} ({len(players)} guild players, {queued} songs queued)\n"
+    message += f"- Spotify requests: {metrics.SPOTIFY_REQUESTS.total()}"
+
+    await interaction.response.send_message(message, ephemeral=True)
+
+
+@tree.command(name="profile", description="Profile the bot for a few seconds (bot owner only)")
+@app_commands.describe(seconds="How long to sample for (1-60)")
+async def profile(interaction: discord.Interaction, seconds: app_commands.Range[int, 1, 60] = 10):
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("Only the bot owner can run this.", ephemeral=True)
+        return
+    if profiler.running:
+        await interaction.response.send_message("A profile is already running.", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    report = await profiler.profile(seconds)
+    report += "\n" + watchdog.report()
+    await interaction.followup.send(
+        f"Profiled for {seconds}s, {metrics.LOOP_STALLS.total()} event loop stalls so far.",
+        file=discord.File(io.BytesIO(report.encode()), filename="profile.txt"),
+        ephemeral=True,
+    )
+
+
+@tasks.loop(hours=1)
+async def maintain_audio_cache():
+    # Sync the index with songs/ once at startup, then keep the cache inside its size budget
+    if maintain_audio_cache.current_loop == 0:
+        await asyncio.to_thread(cache_index.rebuild, DOWNLOAD_FOLDER)
+    freed = await asyncio.to_thread(cache_index.enforce_budget)
+    if freed:
+        print(f"Freed {freed // (1024 * 1024)} MB of cached audio")
+    # Songs cached before loudness analysis existed are measured a batch at a time
+    analyzed = await asyncio.to_thread(analyze_missing)
+    if analyzed:
+        print(f"Measured the loudness of {analyzed} cached songs")
+
+
+@tasks.loop(minutes=1)
+async def reap_idle_players():
+    await players.reap_idle()
+
+
+@tasks.loop(seconds=SESSION_SAVE_INTERVAL)
+async def save_sessions():
+    await session_store.save(players)
 
 
 @bot.event
 async def on_voice_state_update(member, before, after):
-    global current_voice_client
+    player = players.find(member.guild.id)
     
     # If bot is alone in voice channel, disconnect
-    if current_voice_client and current_voice_client.channel:
-        if len(current_voice_client.channel.members) == 1:
-            await current_voice_client.disconnect()
-            current_voice_client = None
-            print("Bot left empty voice channel")
+    if player and player.voice_client and player.voice_client.channel:
+        if len(player.voice_client.channel.members) == 1:
+            player.voice_channel = None
+            await player.voice_client.disconnect()
+            player.voice_client = None
+            player.log("Bot left empty voice channel")
 
 
 if __name__ == "__main__":
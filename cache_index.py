@@ -0,0 +1,219 @@
+import os
+import time
+import sqlite3
+import threading
+
+# Total size the songs/ cache may grow to before the least useful files are evicted
+CACHE_MAX_MB = int(os.getenv("CACHE_MAX_MB", "5120"))
+# "lru" evicts the least recently played files first, "lfu" the least played ones
+CACHE_EVICTION = os.getenv("CACHE_EVICTION", "lru").lower()
+# Files played within this many seconds are never evicted (they may be playing right now)
+CACHE_MIN_AGE = 600
+
+AUDIO_EXTENSIONS = ('.opus', '.webm', '.m4a', '.mp3', '.ogg')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS audio_cache (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    codec TEXT,
+    size INTEGER NOT NULL,
+    duration REAL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    last_access REAL NOT NULL,
+    created REAL NOT NULL,
+    loudness REAL,
+    peak REAL,
+    analyzed_at REAL
+);
+CREATE INDEX IF NOT EXISTS audio_cache_last_access ON audio_cache (last_access);
+CREATE INDEX IF NOT EXISTS audio_cache_path ON audio_cache (path);
+CREATE INDEX IF NOT EXISTS audio_cache_hits ON audio_cache (hits, last_access);
+CREATE TABLE IF NOT EXISTS resolutions (
+    query_key TEXT PRIMARY KEY,
+    video_id TEXT NOT NULL,
+    url TEXT NOT NULL,
+    title TEXT,
+    duration REAL,
+    resolved_at REAL NOT NULL
+);
+"""
+
+
+class CacheIndex:
+    """SQLite manifest of the downloaded audio files, used for lookups and size-budgeted eviction"""
+
+    def __init__(self, db_path, max_bytes=CACHE_MAX_MB * 1024 * 1024, eviction=CACHE_EVICTION, lock_folder=None):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        # Download lock files (<key>.lock) live here, they are removed along with their entry
+        self.lock_folder = lock_folder
+        self._lock = threading.Lock()
+        # Cluster workers share the database, wait for each other's writes instead of failing
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self._db.executescript(SCHEMA)
+
+    def _migrate(self):
+        # Loudness columns were added after the first release of the index
+        columns = {row['name'] for row in self._db.execute("PRAGMA table_info(audio_cache)")}
+        if columns:
+            for column in ('loudness', 'peak', 'analyzed_at'):
+                if column not in columns:
+                    self._db.execute(f"ALTER TABLE audio_cache ADD COLUMN {column} REAL")
+
+    def lookup(self, key):
+        """Return the cached entry for key (and count the hit), or None"""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM audio_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE audio_cache SET hits = hits + 1, last_access = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            return dict(row)
+
+    def record(self, key, path, duration=None):
+        """Add (or replace) the entry for a freshly downloaded file"""
+        now = time.time()
+        codec = os.path.splitext(path)[1].lstrip('.')
+        size = os.path.getsize(path)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO audio_cache (key, path, codec, size, duration, hits, last_access, created) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+                (key, path, codec, size, duration, now, now),
+            )
+
+    def set_loudness(self, key, loudness, peak):
+        """Store the analysis of a cached file, loudness None marks a file that couldn't be measured"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE audio_cache SET loudness = ?, peak = ?, analyzed_at = ? WHERE key = ?",
+                (loudness, peak, time.time(), key),
+            )
+
+    def loudness(self, path):
+        """(loudness, peak) measured for the cached file at path, or None if it wasn't analyzed"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT loudness, peak FROM audio_cache WHERE path = ? AND loudness IS NOT NULL", (path,),
+            ).fetchone()
+        return (row['loudness'], row['peak']) if row else None
+
+    def unanalyzed(self, limit, path=None):
+        """Cached files without a loudness analysis yet (only the one at path if given), most played first"""
+        with self._lock:
+            if path is None:
+                rows = self._db.execute(
+                    "SELECT key, path FROM audio_cache WHERE analyzed_at IS NULL ORDER BY hits DESC LIMIT ?",
+                    (limit,),
+                ).fetchall()
+            else:
+                rows = self._db.execute(
+                    "SELECT key, path FROM audio_cache WHERE analyzed_at IS NULL AND path = ? LIMIT ?",
+                    (path, limit),
+                ).fetchall()
+        return [(row['key'], row['path']) for row in rows]
+
+    def forget(self, key):
+        with self._lock:
+            self._db.execute("DELETE FROM audio_cache WHERE key = ?", (key,))
+        self._remove_lock(key)
+
+    def _remove_lock(self, key):
+        if not self.lock_folder:
+            return
+        try:
+            os.remove(os.path.join(self.lock_folder, key + ".lock"))
+        except OSError:
+            pass
+
+    def get_resolution(self, query_key, max_age):
+        """Return the video a normalized query resolved to, unless it is older than max_age seconds"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT video_id, url, title, duration FROM resolutions WHERE query_key = ? AND resolved_at > ?",
+                (query_key, time.time() - max_age),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def save_resolution(self, query_key, video_id, url, title=None, duration=None):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO resolutions (query_key, video_id, url, title, duration, resolved_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (query_key, video_id, url, title, duration, time.time()),
+            )
+
+    def total_bytes(self):
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM audio_cache").fetchone()[0]
+
+    def rebuild(self, folder):
+        """Sync the index with the files actually on disk: add unknown files, drop missing ones"""
+        on_disk = {}
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                key, ext = os.path.splitext(entry.name)
+                # Hidden files are downloads still in progress
+                if ext in AUDIO_EXTENSIONS and not entry.name.startswith('.') and entry.is_file():
+                    on_disk[key] = entry
+
+        with self._lock:
+            known = {row['key']: row['path'] for row in self._db.execute("SELECT key, path FROM audio_cache")}
+            missing = [key for key, path in known.items() if not os.path.exists(path)]
+            self._db.executemany("DELETE FROM audio_cache WHERE key = ?", [(key,) for key in missing])
+            for key in missing:
+                self._remove_lock(key)
+
+            added = 0
+            for key, entry in on_disk.items():
+                if key in known and key not in missing:
+                    continue
+                stat = entry.stat()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO audio_cache (key, path, codec, size, duration, hits, last_access, created) "
+                    "VALUES (?, ?, ?, ?, NULL, 0, ?, ?)",
+                    (key, entry.path, os.path.splitext(entry.name)[1].lstrip('.'), stat.st_size,
+                     stat.st_mtime, stat.st_mtime),
+                )
+                added += 1
+
+        print(f"🗂️ Cache index rebuilt: {added} added, {len(missing)} removed")
+
+    def enforce_budget(self):
+        """Evict files until the cache fits in max_bytes, returns the number of bytes freed"""
+        order = "hits ASC, last_access ASC" if self.eviction == "lfu" else "last_access ASC"
+        freed = 0
+        with self._lock:
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM audio_cache").fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+
+            candidates = self._db.execute(
+                f"SELECT key, path, size FROM audio_cache WHERE last_access < ? ORDER BY {order}",
+                (time.time() - CACHE_MIN_AGE,),
+            ).fetchall()
+
+            for row in candidates:
+                if total - freed <= self.max_bytes:
+                    break
+                try:
+                    os.remove(row['path'])
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"❌ Could not evict {row['path']}: {e}")
+                    continue
+                self._db.execute("DELETE FROM audio_cache WHERE key = ?", (row['key'],))
+                self._remove_lock(row['key'])
+                freed += row['size']
+                print(f"🗑️ Evicted from cache: {row['path']}")
+
+        return freed
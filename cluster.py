@@ -0,0 +1,145 @@
+"""Run the bot as several worker processes, each handling a slice of its shards.
+
+    python cluster.py [DISCORD_TOKEN SPOTIFY_CLIENT_ID SPOTIFY_CLIENT_SECRET]
+
+The supervisor asks for credentials once, starts CLUSTER_WORKERS copies of
+bot.py with SHARD_IDS/SHARD_COUNT set, and restarts any worker that exits.
+All workers share the songs/ cache: its SQLite index runs in WAL mode and
+downloads are coordinated with lock files.
+"""
+import os
+import sys
+import time
+import signal
+import subprocess
+from credentials import get_credentials
+
+# Worker processes to run
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "2"))
+# Total shards across all workers (Discord requires one per 2500 guilds), defaults to one per worker
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or CLUSTER_WORKERS
+# Each worker serves metrics on METRICS_PORT + its worker number
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+# Rate limits for the whole cluster (same defaults as a single bot), split evenly between the workers
+SPOTIFY_RATE = float(os.getenv("SPOTIFY_RATE", "10"))
+SPOTIFY_BURST = int(os.getenv("SPOTIFY_BURST", "20"))
+RESOLVE_RATE = float(os.getenv("RESOLVE_RATE", "2"))
+# Longest wait before restarting a worker that keeps crashing
+RESTART_DELAY_MAX = 60
+# A worker that ran this long before exiting is restarted right away
+STABLE_AFTER = 60
+# How long workers get to shut down before they are killed
+SHUTDOWN_TIMEOUT = 15
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+
+
+def shard_ids(worker, workers, shard_count):
+    return [shard for shard in range(shard_count) if shard % workers == worker]
+
+
+class Worker:
+    def __init__(self, index, shards, env):
+        self.index = index
+        self.shards = shards
+        self.env = env
+        self.process = None
+        self.started_at = None
+        self.restart_delay = 1
+        self.restart_at = None
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=self.env)
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        print(f"Started worker {self.index} (pid {self.process.pid}, shards {self.shards})")
+
+    def check(self):
+        """Restart the worker if it exited and its backoff has passed"""
+        if self.restart_at is not None:
+            if time.monotonic() >= self.restart_at:
+                self.start()
+            return
+
+        code = self.process.poll()
+        if code is None:
+            return
+        if time.monotonic() - self.started_at > STABLE_AFTER:
+            self.restart_delay = 1
+        print(f"Worker {self.index} exited with code {code}, restarting in {self.restart_delay}s")
+        self.restart_at = time.monotonic() + self.restart_delay
+        self.restart_delay = min(self.restart_delay * 2, RESTART_DELAY_MAX)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+    def wait(self, timeout):
+        if not self.process:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            print(f"Worker {self.index} did not stop in time, killing it")
+            self.process.kill()
+            self.process.wait()
+
+
+def main():
+    credentials = get_credentials()
+    if not all(credentials.values()):
+        print("Discord and Spotify credentials are required. Cluster cannot start.")
+        sys.exit(1)
+
+    workers = max(1, min(CLUSTER_WORKERS, SHARD_COUNT))
+    env = dict(
+        os.environ,
+        DISCORD_TOKEN=credentials['discord_token'],
+        SPOTIFY_CLIENT_ID=credentials['spotify_client_id'],
+        SPOTIFY_CLIENT_SECRET=credentials['spotify_client_secret'],
+        SHARD_COUNT=str(SHARD_COUNT),
+    )
+
+    cluster = []
+    for index in range(workers):
+        shards = shard_ids(index, workers, SHARD_COUNT)
+        worker_env = dict(
+            env,
+            CLUSTER_WORKER=str(index),
+            SHARD_IDS=",".join(map(str, shards)),
+            METRICS_PORT=str(METRICS_PORT + index if METRICS_PORT else 0),
+            # The workers share one Spotify app and one IP, together they stay within the limits
+            SPOTIFY_RATE=str(SPOTIFY_RATE / workers),
+            SPOTIFY_BURST=str(max(1, SPOTIFY_BURST // workers)),
+            RESOLVE_RATE=str(RESOLVE_RATE / workers),
+        )
+        cluster.append(Worker(index, shards, worker_env))
+
+    stopping = False
+
+    def request_stop(signum, _frame):
+        nonlocal stopping
+        stopping = True
+        print(f"Received signal {signum}, stopping workers...")
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    print(f"Running {workers} workers for {SHARD_COUNT} shards")
+    for worker in cluster:
+        worker.start()
+
+    while not stopping:
+        time.sleep(1)
+        for worker in cluster:
+            worker.check()
+
+    for worker in cluster:
+        worker.stop()
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for worker in cluster:
+        worker.wait(max(0, deadline - time.monotonic()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import os
+import sys
+
+
+def get_credentials():
+    """
+    Try multiple methods to get credentials securely:
+    1. Environment variables
+    2. Command line arguments
+    3. Secure input prompts
+    """
+    import getpass
+    
+    credentials = {}
+    
+    discord_token = os.getenv("DISCORD_TOKEN")
+    if not discord_token and len(sys.argv) > 1:
+        discord_token = sys.argv[1]
+    if not discord_token:
+        print("Discord token not found in environment variables.")
+        discord_token = getpass.getpass("Please enter your Discord bot token: ")
+    
+    credentials['discord_token'] = discord_token
+    
+    spotify_client_id = os.getenv("SPOTIFY_CLIENT_ID")
+    spotify_client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
+    
+    if not spotify_client_id and len(sys.argv) > 2:
+        spotify_client_id = sys.argv[2]
+    if not spotify_client_secret and len(sys.argv) > 3:
+        spotify_client_secret = sys.argv[3]
+        
+    if not spotify_client_id:
+        print("Spotify Client ID not found in environment variables.")
+        spotify_client_id = getpass.getpass("Please enter your Spotify Client ID: ")
+    
+    if not spotify_client_secret:
+        print("Spotify Client Secret not found in environment variables.")
+        spotify_client_secret = getpass.getpass("Please enter your Spotify Client Secret: ")
+    
+    credentials['spotify_client_id'] = spotify_client_id
+    credentials['spotify_client_secret'] = spotify_client_secret
+    
+    return credentials
@@ -0,0 +1,189 @@
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from downloader import DEFAULT_PROFILE, download_song, resolve_stream, analyze_file
+
+# Number of yt-dlp downloads allowed to run at the same time
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "3"))
+# How many upcoming queued songs to download while the current one plays
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", "2"))
+
+
+class DownloadPool:
+    """Runs download_song on worker threads so yt-dlp never blocks the event loop.
+
+    Jobs are keyed by job_key(query, profile), so a song needed at two
+    encoding profiles is downloaded once per profile. Guilds asking for the
+    same key share the job, each waiting on its own future; detach() lets one
+    guild stop waiting, and the job is only cancelled once no other guild is
+    waiting on it or prefetching it.
+    """
+
+    def __init__(self, workers=DOWNLOAD_WORKERS, prefetch_count=PREFETCH_COUNT):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+        self._jobs = {}  # job key -> (future, cancel_event)
+        self._prefetched = {}  # owner -> job keys downloading only because they are coming up
+        self._waiters = {}  # job key -> {waiter future: owner} of everyone waiting on the job
+        self._analyzing = set()  # paths whose loudness is being measured
+        self.prefetch_count = prefetch_count
+
+    @staticmethod
+    def job_key(query, profile=None):
+        if profile in (None, DEFAULT_PROFILE):
+            return query
+        return f"{query}@{profile}k"
+
+    @staticmethod
+    def stream_key(query):
+        return f"stream:{query}"
+
+    def submit(self, query, profile=None):
+        """Start downloading query (or join the running job) and return its future"""
+        key = self.job_key(query, profile)
+        if self.is_pending(key):
+            return self._jobs[key][0]
+        future = self._submit(key, lambda cancel_event: download_song(query, cancel_event, profile))
+        future.add_done_callback(self._analyze)
+        return future
+
+    def _analyze(self, future):
+        """Measure a finished download's loudness as a follow-up job, so nobody waits for it"""
+        if future.cancelled() or future.exception() or not future.result():
+            return
+        path = future.result()
+        if path in self._analyzing:
+            return
+        self._analyzing.add(path)
+        analysis = asyncio.get_running_loop().run_in_executor(self._executor, analyze_file, path)
+        analysis.add_done_callback(lambda _done: self._analyzing.discard(path))
+
+    def _submit(self, key, func):
+        job = self._jobs.get(key)
+        if job and not job[0].done():
+            return job[0]
+
+        loop = asyncio.get_running_loop()
+        cancel_event = threading.Event()
+        future = loop.run_in_executor(self._executor, func, cancel_event)
+        self._jobs[key] = (future, cancel_event)
+        future.add_done_callback(lambda done, k=key: self._forget(k, done))
+        return future
+
+    def download(self, query, profile=None, owner=None):
+        """Future for the download of query on behalf of owner, resolves to None if owner detached
+        or the job was cancelled. The wait is registered right away, before it is awaited.
+        """
+        key = self.job_key(query, profile)
+        return self._wait(key, self.submit(query, profile), owner)
+
+    def resolve(self, query, owner=None):
+        """Future for the direct stream URL of query, detach with detach(stream_key(query), owner)"""
+        key = self.stream_key(query)
+        return self._wait(key, self._submit(
+            key, lambda cancel_event: resolve_stream(query, cancel_event),
+        ), owner)
+
+    def _wait(self, key, future, owner):
+        # A separate future per waiter, so cancelling or detaching one waiter never cancels
+        # a job other guilds still need
+        waiter = asyncio.get_running_loop().create_future()
+
+        def relay(done):
+            error = None if done.cancelled() else done.exception()
+            if waiter.done():
+                return
+            if done.cancelled():
+                waiter.set_result(None)
+            elif error is not None:
+                waiter.set_exception(error)
+            else:
+                waiter.set_result(done.result())
+
+        self._waiters.setdefault(key, {})[waiter] = owner
+        waiter.add_done_callback(lambda _waiter: self._unwait(key, waiter))
+        future.add_done_callback(relay)
+        return waiter
+
+    def _unwait(self, key, waiter):
+        waiters = self._waiters.get(key)
+        if waiters is not None:
+            waiters.pop(waiter, None)
+            if not waiters:
+                del self._waiters[key]
+
+    def detach(self, key, owner=None):
+        """Stop owner waiting on the job for key, its waits resolve to None.
+
+        The job itself is cancelled only if nobody else waits on it or
+        prefetches it. Returns True if owner was waiting.
+        """
+        detached = False
+        for waiter, waiter_owner in list(self._waiters.get(key, {}).items()):
+            if waiter_owner == owner and not waiter.done():
+                waiter.set_result(None)
+                detached = True
+        if not self._is_needed(key):
+            self.cancel(key)
+        return detached
+
+    def prefetch(self, upcoming, owner=None, profile=None):
+        """Keep the next prefetch_count songs of a queue downloading in the background.
+
+        upcoming is the owner's queue in play order; prefetches for songs that
+        are no longer coming up (after /skipto, /stop, ...) are cancelled unless
+        another owner still wants them.
+        """
+        wanted = {
+            self.job_key(query, profile): query
+            for query in list(dict.fromkeys(upcoming))[:self.prefetch_count]
+        }
+        prefetched = self._prefetched.setdefault(owner, set())
+
+        for key in list(prefetched):
+            if key not in wanted:
+                prefetched.discard(key)
+                if not self._is_needed(key):
+                    self.cancel(key)
+
+        for key, query in wanted.items():
+            if key in prefetched:
+                continue
+            if not self.is_pending(key):
+                print(f"Prefetching: {query}")
+                self.submit(query, profile)
+            prefetched.add(key)
+
+        if not prefetched:
+            del self._prefetched[owner]
+
+    def is_pending(self, key):
+        job = self._jobs.get(key)
+        return bool(job) and not job[0].done()
+
+    def cancel(self, key):
+        """Cancel the job for key (see job_key), returns True if there was one running"""
+        job = self._jobs.pop(key, None)
+        if not job:
+            return False
+        future, cancel_event = job
+        cancel_event.set()
+        future.cancel()
+        return True
+
+    def drop_prefetches(self, owner=None):
+        """Cancel everything prefetched for owner that nobody else needs"""
+        self.prefetch([], owner)
+
+    def _is_needed(self, key):
+        """True while some owner still waits on or prefetches the job for key"""
+        if any(not waiter.done() for waiter in self._waiters.get(key, {})):
+            return True
+        return any(key in keys for keys in self._prefetched.values())
+
+    def _forget(self, key, future):
+        job = self._jobs.get(key)
+        if job and job[0] is future:
+            del self._jobs[key]
+            for keys in self._prefetched.values():
+                keys.discard(key)
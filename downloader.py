@@ -1,70 +1,371 @@
 import os
-from yt_dlp import YoutubeDL
+import glob
 import hashlib
+import re
+import time
+import unicodedata
+from cache_index import CacheIndex, AUDIO_EXTENSIONS
+from file_lock import FileLock
+from metrics import SEARCH_SECONDS, DOWNLOAD_SECONDS, TRANSCODE_SECONDS, LOUDNESS_SECONDS, CACHE_LOOKUPS
+import loudness
 
 DOWNLOAD_FOLDER = "songs"
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+# One lock file per video, so a song is only ever downloaded by one thread or process at a time
+LOCK_FOLDER = os.path.join(DOWNLOAD_FOLDER, ".locks")
+
+# How long a query -> video resolution is trusted before searching again
+RESOLUTION_TTL = int(os.getenv("RESOLUTION_TTL_DAYS", "30")) * 24 * 3600
+# Search results compared against the expected track length when it is known
+SEARCH_CANDIDATES = 5
+# Share of a song's words the title and channel of an ISRC search result must contain to be trusted
+ISRC_TITLE_MATCH = 0.6
+# Opus bitrates (kbps) songs are stored at, picked to match the voice channel's bitrate
+ENCODING_PROFILES = (64, 96, 128, 192)
+# The profile files were always downloaded at before profiles existed, its files keep the plain video id
+DEFAULT_PROFILE = 192
+# Native Opus streams up to this much above a profile's bitrate are kept as they are instead of re-encoded
+NATIVE_OPUS_HEADROOM = 1.25
+
+def audio_format(profile=DEFAULT_PROFILE):
+    """yt-dlp format selector preferring YouTube's own Opus streams (formats 249/250/251).
+
+    Those are 48 kHz Opus in WebM and only need remuxing into Ogg, so the
+    closest one to the profile is taken before falling back to anything that
+    has to be transcoded.
+    """
+    max_abr = int((profile or DEFAULT_PROFILE) * NATIVE_OPUS_HEADROOM)
+    return f"bestaudio[acodec=opus][abr<={max_abr}]/bestaudio[acodec=opus]/bestaudio/best"
+
+cache_index = CacheIndex(os.path.join(DOWNLOAD_FOLDER, "index.sqlite3"), lock_folder=LOCK_FOLDER)
 
 def sanitize_filename(query):
     return hashlib.md5(query.encode()).hexdigest()
 
-def download_song(query):
-    filename = sanitize_filename(query)
-    base_filepath = os.path.join(DOWNLOAD_FOLDER, filename)
-    
-    # Check for existing files with any extension
-    possible_extensions = ['.opus', '.webm', '.m4a', '.mp3', '.ogg']
-    for ext in possible_extensions:
-        existing_file = base_filepath + ext
-        if os.path.exists(existing_file):
-            print(f"✅ File already exists: {existing_file}")
-            return existing_file
+def normalize_query(query):
+    """Collapse spelling differences so "Song - Artist" and "song – artist" share one cache entry"""
+    query = unicodedata.normalize('NFKC', query).casefold()
+    query = re.sub(r"[^\w\s]", " ", query)
+    return " ".join(query.split())
+
+def video_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+def cached_resolution(query):
+    """Return the video query resolved to earlier, without searching, or None"""
+    return cache_index.get_resolution(normalize_query(query), RESOLUTION_TTL)
+
+def _search(ydl, search):
+    info = ydl.extract_info(search, download=False)
+    return [entry for entry in (info or {}).get('entries') or [] if entry and entry.get('id')]
+
+def _duration_matches(entry, duration):
+    if not duration or not entry.get('duration'):
+        return False
+    # Within 5 seconds or 10%, whichever is looser (radio edits, intros, ...)
+    return abs(entry['duration'] - duration) <= max(5, duration * 0.1)
+
+def _title_matches(entry, query):
+    """True if a result's title and channel mention most words of query ("Song - Artist")"""
+    words = set(normalize_query(query).split())
+    channel = entry.get('channel') or entry.get('uploader') or ''
+    found = set(normalize_query(f"{entry.get('title') or ''} {channel}").split())
+    return bool(words) and len(words & found) >= len(words) * ISRC_TITLE_MATCH
+
+def _best_match(entries, duration):
+    """Pick the search result whose length is closest to the expected one, else the top result"""
+    if duration:
+        matching = [entry for entry in entries if _duration_matches(entry, duration)]
+        if matching:
+            return min(matching, key=lambda entry: abs(entry['duration'] - duration))
+    return entries[0] if entries else None
+
+def resolve_query(query, cancel_event=None, duration_ms=None, isrc=None, before_search=None):
+    """Find the YouTube video for query, from the resolution cache when possible.
+
+    When the track's length (and ISRC) are known, e.g. from Spotify, they are
+    used to pick the right upload among several search results. before_search
+    is called before every YouTube search, e.g. to wait for a rate limit.
+    """
+    resolved = cached_resolution(query)
+    if resolved:
+        return resolved
+
+    if cancel_event is not None and cancel_event.is_set():
+        return None
 
     print(f"🔍 Searching for: {query}")
+    # yt-dlp takes a while to import, so it is only loaded once something needs it
+    from yt_dlp import YoutubeDL
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',  # search results only, no per-video extraction
+    }
+    duration = duration_ms / 1000 if duration_ms else None
+
+    def search(ydl, text):
+        if before_search:
+            before_search()
+        with SEARCH_SECONDS.time():
+            return _search(ydl, text)
+
+    try:
+        with YoutubeDL(ydl_opts) as ydl:
+            entry = None
+            if isrc:
+                # Official uploads usually carry the ISRC in their metadata; the length alone
+                # doesn't prove it's the song, so the title has to match too
+                entries = search(ydl, f'ytsearch1:"{isrc}"')
+                if entries and _duration_matches(entries[0], duration) and _title_matches(entries[0], query):
+                    entry = entries[0]
+            if entry is None:
+                count = SEARCH_CANDIDATES if duration else 1
+                entry = _best_match(search(ydl, f"ytsearch{count}:{query}"), duration)
+
+        if not entry:
+            print(f"❌ No results found for: {query}")
+            return None
+
+        resolved = {
+            'video_id': entry['id'],
+            'url': video_url(entry['id']),
+            'title': entry.get('title'),
+            'duration': entry.get('duration'),
+        }
+        cache_index.save_resolution(normalize_query(query), **resolved)
+        print(f"✅ Resolved: {query} -> {resolved['title']} ({resolved['video_id']})")
+        return resolved
+
+    except Exception as e:
+        print(f"❌ Search error for '{query}': {str(e)}")
+        return None
+
+def encoding_profile(channel_bitrate):
+    """The smallest profile that still carries everything a channel of channel_bitrate (bps) can send"""
+    if not channel_bitrate:
+        return DEFAULT_PROFILE
+    kbps = channel_bitrate // 1000
+    return next((profile for profile in ENCODING_PROFILES if profile >= kbps), ENCODING_PROFILES[-1])
+
+def variant_key(video_id, profile=DEFAULT_PROFILE):
+    """Cache key (and file name) of a video stored at profile"""
+    if profile in (None, DEFAULT_PROFILE):
+        return video_id
+    return f"{video_id}-{profile}k"
+
+def cached_entry(key):
+    """Index entry for key if its file is still on disk, an entry whose file is gone is dropped"""
+    cached = cache_index.lookup(key)
+    if cached and not os.path.exists(cached['path']):
+        print(f"🗂️ Cached file is missing, it will be downloaded again: {cached['path']}")
+        cache_index.forget(key)
+        return None
+    return cached
+
+def find_variant(video_id, profile=DEFAULT_PROFILE):
+    """The cached file for video_id at profile, or failing that at the closest higher profile"""
+    profile = profile or DEFAULT_PROFILE
+    for candidate in sorted(p for p in set(ENCODING_PROFILES) | {profile} if p >= profile):
+        cached = cached_entry(variant_key(video_id, candidate))
+        if cached:
+            return cached
+    return None
+
+def cached_song(query, profile=DEFAULT_PROFILE):
+    """Return the cached file for query without searching or downloading, or None"""
+    resolved = cached_resolution(query)
+    if resolved:
+        cached = find_variant(resolved['video_id'], profile)
+    else:
+        cached = cached_entry(sanitize_filename(query))
+    return cached['path'] if cached else None
+
+def analyze_loudness(key, path):
+    """Measure a cached file's loudness once and store it in the index"""
+    with LOUDNESS_SECONDS.time():
+        measured = loudness.measure(path)
+    cache_index.set_loudness(key, *(measured or (None, None)))
+    if measured:
+        print(f"🔊 Loudness of {path}: {measured[0]:.1f} LUFS, peak {measured[1]} dBTP")
 
-    # Simplified options for reliability
+def analyze_file(path):
+    """Measure a downloaded file unless that was done already, returns True if it was analyzed now.
+
+    Runs after the download has been handed to the player, until then the
+    song plays at gain 0.
+    """
+    if not loudness.LOUDNESS_NORMALIZATION:
+        return False
+    pending = cache_index.unanalyzed(1, path=path)
+    for key, path in pending:
+        analyze_loudness(key, path)
+    return bool(pending)
+
+def analyze_missing(limit=100):
+    """Analyze cached files from before loudness analysis existed, returns how many were done"""
+    if not loudness.LOUDNESS_NORMALIZATION:
+        return 0
+    pending = cache_index.unanalyzed(limit)
+    for key, path in pending:
+        analyze_loudness(key, path)
+    return len(pending)
+
+def track_gain(path):
+    """Gain in dB that brings the cached file at path to the target loudness (0 if unknown)"""
+    if not loudness.LOUDNESS_NORMALIZATION:
+        return 0.0
+    measured = cache_index.loudness(path)
+    return loudness.gain_db(*measured) if measured else 0.0
+
+def resolve_stream(query, cancel_event=None):
+    """Find the direct audio URL for query so FFmpeg can stream it without a download"""
+    resolved = resolve_query(query, cancel_event)
+    if not resolved:
+        return None
+
+    from yt_dlp import YoutubeDL
     ydl_opts = {
         'format': 'bestaudio/best',
+        'quiet': True,
+        'no_warnings': True,
+        'noplaylist': True,
+    }
+
+    try:
+        with YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(resolved['url'], download=False)
+
+        print(f"✅ Resolved stream: {info.get('title', 'Unknown')}")
+        return {
+            'url': info['url'],
+            'http_headers': info.get('http_headers', {}),
+            'title': info.get('title'),
+            'duration': info.get('duration'),
+        }
+
+    except Exception as e:
+        print(f"❌ Stream resolve error for '{query}': {str(e)}")
+        return None
+
+def download_song(query, cancel_event=None, profile=DEFAULT_PROFILE):
+    # Files from before query resolution was cached are still keyed by the raw query
+    cached = cached_entry(sanitize_filename(query))
+    if cached:
+        print(f"✅ File already exists: {cached['path']}")
+        CACHE_LOOKUPS.inc(result="hit")
+        return cached['path']
+
+    resolved = resolve_query(query, cancel_event)
+    if not resolved:
+        return None
+
+    # Audio is stored per video and profile, so every spelling of the same song shares one file
+    profile = profile or DEFAULT_PROFILE
+    filename = variant_key(resolved['video_id'], profile)
+
+    # Indexed reads instead of probing every extension on disk; a better variant will do too
+    cached = find_variant(resolved['video_id'], profile)
+    if cached:
+        print(f"✅ File already exists: {cached['path']}")
+        CACHE_LOOKUPS.inc(result="hit")
+        return cached['path']
+
+    # Whoever holds the lock downloads, everyone else waits for it and reuses the file
+    lock = FileLock(os.path.join(LOCK_FOLDER, filename + ".lock"))
+    if not lock.acquire(cancel_event):
+        print(f"⏹️ Download cancelled while waiting for another download: {query}")
+        return None
+    try:
+        cached = find_variant(resolved['video_id'], profile)
+        if cached:
+            print(f"✅ Downloaded by another worker: {cached['path']}")
+            CACHE_LOOKUPS.inc(result="hit")
+            return cached['path']
+        CACHE_LOOKUPS.inc(result="miss")
+        return _download(query, resolved, cancel_event, profile)
+    finally:
+        lock.release()
+
+def _download(query, resolved, cancel_event=None, profile=DEFAULT_PROFILE):
+    """Download resolved into the cache at profile, the caller must hold the variant's lock"""
+    filename = variant_key(resolved['video_id'], profile)
+    base_filepath = os.path.join(DOWNLOAD_FOLDER, filename)
+    # yt-dlp writes to a hidden temp name, the finished file is renamed into place
+    # so other processes never see a partial download under the real name
+    temp_filepath = os.path.join(DOWNLOAD_FOLDER, f".{filename}.{os.getpid()}.tmp")
+    from yt_dlp import YoutubeDL
+    from yt_dlp.utils import DownloadCancelled
+
+    # Opus sources are only copied into an Ogg container by ExtractAudio, the bitrate
+    # applies when anything else has to be transcoded. Opus always decodes at 48 kHz,
+    # so no resampling arguments are needed (they would force a transcode).
+    ydl_opts = {
+        'format': audio_format(profile),
         'quiet': False,
         'no_warnings': False,
-        'outtmpl': base_filepath + '.%(ext)s',
+        'outtmpl': temp_filepath + '.%(ext)s',
         'postprocessors': [{
             'key': 'FFmpegExtractAudio',
             'preferredcodec': 'opus',
-            'preferredquality': '192',  # Good quality but more reliable
+            'preferredquality': str(profile),  # kbps, no more than the voice channel carries
         }],
-        'postprocessor_args': [
-            '-ar', '48000',
-            '-ac', '2',
-        ],
     }
 
+    if cancel_event is not None and cancel_event.is_set():
+        print(f"⏹️ Download cancelled before start: {query}")
+        return None
+
+    started = time.perf_counter()
+    transcode_started = None
+
+    def check_cancelled():
+        # Lets the download pool abort a running job (e.g. on /skip or /stop)
+        if cancel_event is not None and cancel_event.is_set():
+            raise DownloadCancelled(f"Download cancelled: {query}")
+
+    def on_progress(status):
+        check_cancelled()
+        if status['status'] == 'finished':
+            DOWNLOAD_SECONDS.observe(time.perf_counter() - started)
+
+    def on_postprocess(status):
+        nonlocal transcode_started
+        check_cancelled()
+        if status.get('postprocessor') != 'ExtractAudio':
+            return
+        if status['status'] == 'started':
+            transcode_started = time.perf_counter()
+        elif status['status'] == 'finished' and transcode_started is not None:
+            source_codec = (status.get('info_dict') or {}).get('acodec')
+            mode = "remux" if source_codec == 'opus' else "transcode"
+            TRANSCODE_SECONDS.observe(time.perf_counter() - transcode_started, mode=mode)
+
+    ydl_opts['progress_hooks'] = [on_progress]
+    ydl_opts['postprocessor_hooks'] = [on_postprocess]
+
     try:
         with YoutubeDL(ydl_opts) as ydl:
-            print(f"🔍 Extracting info for: {query}")
-            info = ydl.extract_info(f"ytsearch1:{query}", download=True)
+            print(f"🔍 Extracting info for: {query} ({profile} kbps)")
+            info = ydl.extract_info(resolved['url'], download=True)
                         
-            if info and 'entries' in info and len(info['entries']) > 0:
-                video_title = info['entries'][0].get('title', 'Unknown')
+            if info:
+                video_title = info.get('title', 'Unknown')
+                duration = info.get('duration')
                 print(f"✅ Downloaded: {video_title}")
                 
                 # Check what file was actually created
-                print(f"📂 Checking for files with base: {base_filepath}")
-                
-                # List all files in the download folder to see what was created
-                try:
-                    all_files = os.listdir(DOWNLOAD_FOLDER)
-                    matching_files = [f for f in all_files if f.startswith(filename)]
-                    print(f"📁 Files starting with {filename}: {matching_files}")
-                except Exception as e:
-                    print(f"❌ Error listing files: {e}")
+                print(f"📂 Checking for files with base: {temp_filepath}")
                 
                 # Check for the created file with any extension
-                for ext in possible_extensions:
-                    final_filepath = base_filepath + ext
-                    if os.path.exists(final_filepath):
+                for ext in AUDIO_EXTENSIONS:
+                    if os.path.exists(temp_filepath + ext):
+                        final_filepath = base_filepath + ext
+                        os.replace(temp_filepath + ext, final_filepath)
                         file_size = os.path.getsize(final_filepath)
                         print(f"✅ Found file: {final_filepath} ({file_size} bytes)")
+                        cache_index.record(filename, final_filepath, duration)
+                        cache_index.enforce_budget()
                         return final_filepath
                 
                 print(f"❌ No output file found after download")
@@ -72,9 +373,19 @@ def download_song(query):
             else:
                 print(f"❌ No results found for: {query}")
                 return None
-                    
+
+    except DownloadCancelled:
+        print(f"⏹️ Download cancelled: {query}")
+        return None
     except Exception as e:
         print(f"❌ Download error for '{query}': {str(e)}")
         import traceback
         traceback.print_exc()
-        return None
\ No newline at end of file
+        return None
+    finally:
+        # Partial downloads and leftovers of a failed conversion
+        for leftover in glob.glob(temp_filepath + ".*"):
+            try:
+                os.remove(leftover)
+            except OSError:
+                pass
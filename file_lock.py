@@ -0,0 +1,73 @@
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    """Exclusive lock on a file, shared by threads and by processes on the same machine.
+
+    Waiting polls a non-blocking lock, so a waiter can give up when its
+    cancel_event is set instead of hanging until the holder is done.
+    """
+
+    def __init__(self, path, poll_interval=0.1):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    def acquire(self, cancel_event=None, timeout=None):
+        """Wait for the lock, returns False if cancelled or timed out first"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._try_lock(fd):
+                self._fd = fd
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if cancel_event is not None:
+                if cancel_event.wait(self.poll_interval):
+                    break
+            else:
+                time.sleep(self.poll_interval)
+        os.close(fd)
+        return False
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    @staticmethod
+    def _try_lock(fd):
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
@@ -0,0 +1,178 @@
+import os
+import sys
+import time
+import signal
+import asyncio
+import threading
+import traceback
+from collections import Counter, deque
+from metrics import LOOP_STALLS, LOOP_STALL_SECONDS
+
+# The event loop counts as stalled once it hasn't run a callback for this long (0 = watchdog off)
+LOOP_LAG_THRESHOLD_MS = int(os.getenv("LOOP_LAG_THRESHOLD_MS", "250"))
+# Stalls kept in memory for /profile
+STALL_HISTORY = 20
+# How often the profiler samples the event loop thread's stack
+PROFILE_INTERVAL = 0.005
+# Longest /profile run allowed
+PROFILE_MAX_SECONDS = 60
+
+
+def format_stack(frame, limit=30):
+    return "".join(traceback.format_stack(frame, limit=limit))
+
+
+class LoopWatchdog:
+    """Notices when the event loop stops running callbacks and records what was blocking it.
+
+    The loop bumps a heartbeat every interval; a background thread checks it and,
+    when it goes stale past the threshold, grabs the loop thread's current stack.
+    That stack is the blocking call, caught while it is still running.
+    """
+
+    def __init__(self, threshold_ms=LOOP_LAG_THRESHOLD_MS):
+        self.threshold = threshold_ms / 1000
+        self.interval = max(self.threshold / 4, 0.01)
+        self.stalls = deque(maxlen=STALL_HISTORY)  # (started at, seconds, stack)
+        self._loop = None
+        self._loop_thread_id = None
+        self._heartbeat = time.monotonic()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def start(self, loop=None):
+        if not self.enabled or self._thread is not None:
+            return
+        self._loop = loop or asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._beat()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        print(f"Loop watchdog on, reporting stalls over {self.threshold * 1000:.0f} ms")
+
+    def stop(self):
+        self._stopped.set()
+
+    def _beat(self):
+        self._heartbeat = time.monotonic()
+        if not self._stopped.is_set():
+            self._loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        stall_start = None
+        stack = None
+        while not self._stopped.wait(self.interval):
+            lag = time.monotonic() - self._heartbeat - self.interval
+            if lag > self.threshold:
+                if stall_start is None:
+                    stall_start = self._heartbeat + self.interval
+                    frame = sys._current_frames().get(self._loop_thread_id)
+                    stack = format_stack(frame) if frame else "(loop thread not found)"
+            elif stall_start is not None:
+                self._record(stall_start, lag_end=self._heartbeat, stack=stack)
+                stall_start = stack = None
+
+    def _record(self, stall_start, lag_end, stack):
+        seconds = lag_end - stall_start
+        LOOP_STALLS.inc()
+        LOOP_STALL_SECONDS.observe(seconds)
+        self.stalls.append((time.time() - (time.monotonic() - stall_start), seconds, stack))
+        print(f"⚠️ Event loop blocked for {seconds * 1000:.0f} ms in:\n{stack}")
+
+    def report(self):
+        if not self.stalls:
+            return "No event loop stalls recorded.\n"
+        lines = [f"Last {len(self.stalls)} event loop stalls:\n"]
+        for started, seconds, stack in reversed(self.stalls):
+            when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started))
+            lines.append(f"--- {when}, blocked {seconds * 1000:.0f} ms ---\n{stack}")
+        return "\n".join(lines)
+
+
+class SamplingProfiler:
+    """Samples the event loop thread's stack for a while and counts where time went.
+
+    When the loop runs on the main thread (as it does under bot.run) samples come
+    from a SIGALRM interval timer, so they land wherever the loop actually is. A
+    sampling thread would mostly see the loop in select(), because that is where it
+    hands over the GIL. The thread is only the fallback on Windows.
+    Nothing runs until profile() is called, and only one profile runs at a time.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.running = False
+
+    @staticmethod
+    def _location(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _record(self, frame, own, cumulative):
+        own[self._location(frame)] += 1
+        seen = set()
+        while frame is not None:
+            location = self._location(frame)
+            if location not in seen:
+                seen.add(location)
+                cumulative[location] += 1
+            frame = frame.f_back
+
+    async def _sample_with_timer(self, seconds, own, cumulative):
+        def on_alarm(_signum, frame):
+            if frame is not None:
+                self._record(frame, own, cumulative)
+
+        previous = signal.signal(signal.SIGALRM, on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+    def _sample_from_thread(self, thread_id, seconds, own, cumulative):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                self._record(frame, own, cumulative)
+            time.sleep(self.interval)
+
+    async def profile(self, seconds):
+        """Profile the running event loop for seconds and return a text report"""
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        self.running = True
+        own = Counter()
+        cumulative = Counter()
+        seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+        try:
+            if hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread():
+                await self._sample_with_timer(seconds, own, cumulative)
+            else:
+                await asyncio.to_thread(self._sample_from_thread, threading.get_ident(), seconds, own, cumulative)
+        finally:
+            self.running = False
+        return self._report(seconds, sum(own.values()), own, cumulative)
+
+    @staticmethod
+    def _report(seconds, samples, own, cumulative, top=25):
+        if not samples:
+            return "No samples collected.\n"
+        lines = [f"Sampled the event loop {samples} times over {seconds}s.\n",
+                 "Own time (where the loop thread was when sampled):"]
+        for location, count in own.most_common(top):
+            lines.append(f"{count / samples:7.1%}  {location}")
+        lines.append("\nCumulative time (anywhere on the stack):")
+        for location, count in cumulative.most_common(top):
+            lines.append(f"{count / samples:7.1%}  {location}")
+        return "\n".join(lines) + "\n"
+
+
+watchdog = LoopWatchdog()
+profiler = SamplingProfiler()
@@ -0,0 +1,64 @@
+import os
+import re
+import json
+import math
+import subprocess
+
+# Analyze every downloaded song once and play it back at a common loudness. Off by default:
+# most songs need more correction than PASSTHROUGH_MAX_GAIN_DB, so they'd go through FFmpeg
+LOUDNESS_NORMALIZATION = os.getenv("LOUDNESS_NORMALIZATION", "0") == "1"
+# Integrated loudness (LUFS, EBU R128) songs are brought to
+LOUDNESS_TARGET = float(os.getenv("LOUDNESS_TARGET", "-14"))
+# Gains smaller than this (dB) are skipped so cached Opus can still be sent without re-encoding
+PASSTHROUGH_MAX_GAIN_DB = float(os.getenv("PASSTHROUGH_MAX_GAIN_DB", "1.5"))
+# Boosting quiet songs never pushes their true peak above this (dBTP)
+TRUE_PEAK_CEILING = -1.0
+# Longest an analysis may take before it is given up on
+ANALYSIS_TIMEOUT = 120
+
+_LOUDNORM_JSON = re.compile(r'\{[^{}]*"input_i"[^{}]*\}')
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def measure(path):
+    """Integrated loudness (LUFS) and true peak (dBTP) of an audio file, or None if it can't be measured.
+
+    Decodes the whole file once with FFmpeg's loudnorm filter in analysis mode.
+    """
+    command = [
+        'ffmpeg', '-hide_banner', '-nostats', '-i', path,
+        '-af', 'loudnorm=print_format=json', '-f', 'null', '-',
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, timeout=ANALYSIS_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"❌ Loudness analysis failed for {path}: {e}")
+        return None
+
+    match = _LOUDNORM_JSON.search(result.stderr)
+    if result.returncode != 0 or not match:
+        print(f"❌ Loudness analysis failed for {path}: ffmpeg exited with {result.returncode}")
+        return None
+    stats = json.loads(match.group(0))
+    loudness = _number(stats.get('input_i'))
+    if loudness is None:
+        # Silent track, nothing to normalize
+        return None
+    return loudness, _number(stats.get('input_tp'))
+
+
+def gain_db(loudness, peak=None):
+    """Constant gain that brings a song of loudness (LUFS) to the target without clipping"""
+    if loudness is None:
+        return 0.0
+    gain = LOUDNESS_TARGET - loudness
+    if peak is not None:
+        gain = min(gain, TRUE_PEAK_CEILING - peak)
+    return round(gain, 2)
@@ -0,0 +1,193 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+# Where the Prometheus endpoint listens, METRICS_PORT=0 turns it off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def total(self):
+        return sum(self._values.values())
+
+    def _samples(self):
+        with self._lock:
+            return [f"{self.name}{_format_labels(key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """A value that goes up and down; either set() directly or computed at scrape time"""
+
+    type = "gauge"
+
+    def __init__(self, name, help, function=None):
+        super().__init__(name, help)
+        self._values = {}
+        # Returns a single number, or a list of (labels dict, value) pairs
+        self._function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def collect(self):
+        if self._function is None:
+            with self._lock:
+                return dict(self._values)
+        values = self._function()
+        if isinstance(values, list):
+            return {_label_key(labels): value for labels, value in values}
+        return {(): values}
+
+    def _samples(self):
+        return [f"{self.name}{_format_labels(key)} {value}" for key, value in self.collect().items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., count, sum]
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def summary(self):
+        """(count, average) over every label set, for human-readable reports"""
+        with self._lock:
+            count = sum(series[-2] for series in self._series.values())
+            total = sum(series[-1] for series in self._series.values())
+        return count, (total / count if count else 0.0)
+
+    def _samples(self):
+        lines = []
+        with self._lock:
+            for key, series in self._series.items():
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-2]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+async def start_http_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve /metrics for Prometheus, returns the aiohttp runner (None when disabled or the port is unavailable)"""
+    if not port:
+        return None
+    from aiohttp import web
+
+    async def handle(_request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        # e.g. the port is taken; the bot runs fine without the endpoint
+        print(f"Could not start metrics endpoint on {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    print(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
+
+
+SEARCH_SECONDS = Histogram("musicbot_search_seconds", "Time spent searching YouTube for a song")
+DOWNLOAD_SECONDS = Histogram("musicbot_download_seconds", "Time spent downloading a song's audio")
+TRANSCODE_SECONDS = Histogram(
+    "musicbot_transcode_seconds", "Time spent converting a downloaded song, by mode (remux/transcode)",
+)
+LOUDNESS_SECONDS = Histogram("musicbot_loudness_analysis_seconds", "Time spent measuring a downloaded song's loudness")
+FIRST_AUDIO_SECONDS = Histogram("musicbot_time_to_first_audio_seconds", "Time from /play or /playlist to audio starting")
+TRACK_GAP_SECONDS = Histogram(
+    "musicbot_track_gap_seconds", "Silence between one song ending and the next starting",
+    buckets=(0.02, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+CACHE_LOOKUPS = Counter("musicbot_cache_lookups_total", "Audio cache lookups by result (hit/miss)")
+SPOTIFY_REQUESTS = Counter("musicbot_spotify_requests_total", "Requests sent to the Spotify API by endpoint")
+SPOTIFY_THROTTLED = Counter("musicbot_spotify_throttled_total", "Times Spotify answered 429 and requests were paused")
+SPOTIFY_WAIT_SECONDS = Histogram(
+    "musicbot_spotify_wait_seconds", "Time a Spotify request waited for its turn, by lane (interactive/background)",
+)
+LOOP_STALLS = Counter("musicbot_loop_stalls_total", "Times the event loop was blocked past the lag threshold")
+LOOP_STALL_SECONDS = Histogram("musicbot_loop_stall_seconds", "How long each event loop stall lasted")
@@ -0,0 +1,144 @@
+import mmap
+import struct
+import discord
+
+OGG_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+# Samples in one 20 ms frame at 48 kHz, the only packet length discord.py paces correctly
+FRAME_SAMPLES = 960
+# How many audio packets to check for 20 ms framing before trusting a file
+FRAMING_CHECK_PACKETS = 50
+
+
+def opus_packet_samples(packet):
+    """Number of 48 kHz samples in an Opus packet, read from its TOC byte (RFC 6716 3.1)"""
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        frame = (480, 960, 1920, 2880)[config % 4]    # SILK 10/20/40/60 ms
+    elif config < 16:
+        frame = (480, 960)[config % 2]                # Hybrid 10/20 ms
+    else:
+        frame = (120, 240, 480, 960)[config % 4]      # CELT 2.5/5/10/20 ms
+
+    code = toc & 0x03
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    else:
+        frames = packet[1] & 0x3F if len(packet) > 1 else 0
+    return frame * frames
+
+
+class OggOpusSource(discord.AudioSource):
+    """Plays an Ogg Opus file by sending its packets as-is, no FFmpeg and no re-encoding.
+
+    The file is memory-mapped and demuxed page by page as discord.py asks for
+    the next 20 ms packet. Use open() rather than the constructor: it returns
+    None for files that can't be passed through, so callers can fall back to
+    FFmpegPCMAudio.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = None
+        self._pending = []
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._packets = self._iter_packets()
+            self._read_headers()
+        except (ValueError, OSError):
+            self.cleanup()
+            raise
+
+    @classmethod
+    def open(cls, path):
+        try:
+            source = cls(path)
+        except (OSError, ValueError) as e:
+            print(f"Opus passthrough unavailable for {path}: {e}")
+            return None
+        if not source._check_framing():
+            print(f"Opus passthrough unavailable for {path}: packets are not 20 ms frames")
+            source.cleanup()
+            return None
+        return source
+
+    def is_opus(self):
+        return True
+
+    def read(self):
+        if self._pending:
+            return self._pending.pop(0)
+        try:
+            return next(self._packets, b'')
+        except ValueError as e:
+            # Truncated or corrupt file: end the song instead of crashing the audio thread
+            print(f"Stopping passthrough of {self.path}: {e}")
+            self._packets = iter(())
+            return b''
+
+    def skip(self, packets):
+        """Drop the next packets (each one is 20 ms), used to resume mid-song"""
+        for _ in range(packets):
+            if not self.read():
+                break
+
+    def cleanup(self):
+        self._packets = iter(())
+        self._pending = []
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def _read_headers(self):
+        head = next(self._packets, b'')
+        if not head.startswith(b'OpusHead'):
+            raise ValueError("not an Ogg Opus file")
+        tags = next(self._packets, b'')
+        if not tags.startswith(b'OpusTags'):
+            raise ValueError("missing OpusTags header")
+
+    def _check_framing(self):
+        # Look ahead at the first packets and keep them to be played
+        for _ in range(FRAMING_CHECK_PACKETS):
+            packet = next(self._packets, b'')
+            if not packet:
+                break
+            self._pending.append(packet)
+            if opus_packet_samples(packet) != FRAME_SAMPLES:
+                return False
+        return bool(self._pending)
+
+    def _iter_packets(self):
+        data = self._map
+        offset = 0
+        end = len(data)
+        partial = b''
+
+        while offset + OGG_PAGE_HEADER.size <= end:
+            capture, version, _flags, _granule, _serial, _seqno, _crc, segments = \
+                OGG_PAGE_HEADER.unpack_from(data, offset)
+            if capture != b'OggS' or version != 0:
+                raise ValueError(f"corrupt Ogg page at byte {offset}")
+
+            table_start = offset + OGG_PAGE_HEADER.size
+            lacing = data[table_start:table_start + segments]
+            position = table_start + segments
+            packet_start = position
+
+            for size in lacing:
+                position += size
+                if size < 255:
+                    # A lacing value below 255 ends the packet, empty (DTX) packets carry nothing to send
+                    packet = partial + data[packet_start:position]
+                    if packet:
+                        yield packet
+                    partial = b''
+                    packet_start = position
+
+            # Packet continues on the next page
+            partial += data[packet_start:position]
+            offset = position
@@ -0,0 +1,549 @@
+import os
+import time
+import asyncio
+import shlex
+import traceback
+from discord import FFmpegPCMAudio
+from downloader import cached_song, encoding_profile, track_gain
+from loudness import PASSTHROUGH_MAX_GAIN_DB
+from metrics import FIRST_AUDIO_SECONDS, TRACK_GAP_SECONDS
+from opus_source import OggOpusSource
+from spotify_utils import track_query
+from track_queue import TrackQueue, normalize_text
+
+# Seconds a player may sit idle before its voice connection and state are torn down
+PLAYER_IDLE_TIMEOUT = int(os.getenv("PLAYER_IDLE_TIMEOUT", "300"))
+# Stream songs that aren't cached yet straight from their URL instead of downloading first
+STREAM_MODE = os.getenv("STREAM_MODE", "0") == "1"
+# While streaming, also download the song in the background so replays come from the cache
+STREAM_CACHE = os.getenv("STREAM_CACHE", "1") == "1"
+# Send cached Ogg Opus packets to Discord as-is instead of decoding and re-encoding them with FFmpeg
+OPUS_PASSTHROUGH = os.getenv("OPUS_PASSTHROUGH", "1") == "1"
+
+# Playback states of a GuildPlayer
+IDLE = "idle"        # nothing playing, ready to pick the next song
+LOADING = "loading"  # a song was taken from the queue and is being downloaded
+PLAYING = "playing"  # audio is playing (or paused) in the voice channel
+
+
+class GuildPlayer:
+    """Queue, voice connection and playback state for a single guild"""
+
+    def __init__(self, guild_id, download_pool, resolver):
+        self.guild_id = guild_id
+        self.download_pool = download_pool
+        self.resolver = resolver
+        self.loop = asyncio.get_running_loop()
+        self.queue = TrackQueue()
+        self.voice_client = None
+        self.voice_channel = None
+        self.text_channel = None
+        self.now_playing = None
+        self.loading_query = None
+        self.state = IDLE
+        self.ingest_tasks = set()
+        self.last_active = time.monotonic()
+        self.track_ended_at = None  # when the previous song finished, for the gap metric
+        # The next song's audio source, opened ahead of time so it can start the moment the
+        # current one ends: (query, source, generation). Only touched on the event loop.
+        self.armed = None
+        self._arm_task = None
+        self._generation = 0  # bumped whenever an armed source stops being valid
+        self.resume_at = 0  # seconds into the next song to start from (after a restart)
+        self.playback_started = None  # monotonic time the current song was at 0:00
+        self.paused_at = None
+
+    def log(self, message):
+        print(f"[{self.guild_id}] {message}")
+
+    @property
+    def is_playing(self):
+        return self.state == PLAYING
+
+    @property
+    def profile(self):
+        """Encoding profile matching the voice channel's bitrate, so no bits are stored that it can't carry"""
+        return encoding_profile(getattr(self.voice_channel, 'bitrate', None))
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def position(self):
+        """Seconds into the current song"""
+        if not self.now_playing or self.playback_started is None:
+            return 0
+        return (self.paused_at or time.monotonic()) - self.playback_started
+
+    def pause(self):
+        if self.voice_client and self.voice_client.is_playing():
+            self.voice_client.pause()
+            self.paused_at = time.monotonic()
+            return True
+        return False
+
+    def resume(self):
+        if self.voice_client and self.voice_client.is_paused():
+            self.voice_client.resume()
+            if self.paused_at is not None and self.playback_started is not None:
+                self.playback_started += time.monotonic() - self.paused_at
+            self.paused_at = None
+            return True
+        return False
+
+    def is_connected(self):
+        return self.voice_client is not None and self.voice_client.is_connected()
+
+    def is_idle(self, timeout=PLAYER_IDLE_TIMEOUT):
+        """True when nothing is queued or playing and nobody used the player for timeout seconds"""
+        if self.state != IDLE or not self.queue.empty() or self.ingest_tasks:
+            return False
+        if self.voice_client and (self.voice_client.is_playing() or self.voice_client.is_paused()):
+            return False
+        return time.monotonic() - self.last_active > timeout
+
+    async def connect(self, channel):
+        """Connect to channel unless already connected, raises like VoiceChannel.connect"""
+        if not self.is_connected():
+            self.voice_client = await channel.connect()
+            self.log(f"Connected to {channel.name}")
+        # The channel the bot is really in, which isn't channel if it was already connected elsewhere
+        self.voice_channel = self.voice_client.channel
+        return self.voice_client
+
+    async def announce(self, message):
+        if not self.text_channel:
+            return
+        try:
+            await self.text_channel.send(message)
+        except Exception as msg_error:
+            self.log(f"Could not send message: {msg_error}")
+
+    def enqueue(self, query):
+        position = self.queue.put(query)
+        self.refresh_prefetch()
+        return position
+
+    def enqueue_many(self, queries):
+        size = self.queue.extend(queries)
+        self.refresh_prefetch()
+        return size
+
+    def enqueue_tracks(self, tracks):
+        """Queue parsed Spotify tracks and have them resolved to videos in the background"""
+        size = self.enqueue_many([track_query(track) for track in tracks])
+        self.resolver.submit(tracks, track_query, owner=self.guild_id)
+        return size
+
+    async def restore(self, channel, now_playing, queue, position=0):
+        """Rejoin channel and continue a saved session, the interrupted song resumes at position"""
+        # Connected first, so nothing is queued if that fails and prefetches use the channel's profile
+        await self.connect(channel)
+        tracks = ([now_playing] if now_playing else []) + list(queue)
+        self.enqueue_many(tracks)
+        self.resume_at = position if now_playing else 0
+        await self.play_next()
+
+    def start_ingest(self, pages):
+        """Keep queueing the remaining pages of a playlist in the background"""
+        task = asyncio.create_task(self._ingest(pages))
+        self.ingest_tasks.add(task)
+        task.add_done_callback(self.ingest_tasks.discard)
+        return task
+
+    async def _ingest(self, pages):
+        added = 0
+        try:
+            async for tracks in pages:
+                if not tracks:
+                    continue
+                self.enqueue_tracks(tracks)
+                added += len(tracks)
+                if self.state == IDLE and self.voice_channel:
+                    await self.play_next()
+        except asyncio.CancelledError:
+            self.log(f"Playlist loading cancelled after {added} more songs")
+            raise
+        except Exception as e:
+            self.log(f"Error loading playlist: {e}")
+            await self.announce(f"Error loading the rest of the playlist: {e}")
+        else:
+            if added:
+                await self.announce(f"Finished loading playlist: queued {added} more songs.")
+        finally:
+            await pages.aclose()
+
+    def refresh_prefetch(self):
+        """Point the download look-ahead at the songs that are coming up next"""
+        upcoming = self.queue.peek(self.download_pool.prefetch_count)
+        self.download_pool.prefetch(upcoming, owner=self.guild_id, profile=self.profile)
+        if self.state == PLAYING:
+            self._schedule_arm()
+
+    def _schedule_arm(self):
+        if self.armed or (self._arm_task and not self._arm_task.done()) or self.queue.empty():
+            return
+        self._arm_task = asyncio.create_task(self._arm_next())
+
+    async def _arm_next(self):
+        """Open the next song's audio source while the current one is still playing"""
+        query = self.queue.peek(1)[0]
+        generation = self._generation
+        if STREAM_MODE and not cached_song(query, self.profile):
+            # Stream URLs expire, those are resolved when the song actually starts
+            return
+
+        path = await self.download_pool.download(query, self.profile, self.guild_id)
+        if not path or generation != self._generation or self.state != PLAYING:
+            return
+        path = self._check_file(path)
+        if not path:
+            return
+        try:
+            source = await asyncio.to_thread(self._open_source, path, {'options': '-vn'})
+        except Exception as e:
+            # play_next will try again (and report it) when the song comes up
+            self.log(f"Could not arm next song {query}: {e}")
+            return
+
+        still_next = generation == self._generation and self.queue.peek(1) == [query]
+        if still_next and self.state == PLAYING and self.armed is None:
+            self.armed = (query, source, generation)
+            source = None
+        if source is not None:
+            source.cleanup()
+        else:
+            self.log(f"Armed next song: {query}")
+
+    def _disarm(self):
+        """Drop the pre-opened next song, e.g. because the queue head changed"""
+        armed, self.armed = self.armed, None
+        self._generation += 1
+        if self._arm_task:
+            self._arm_task.cancel()
+            self._arm_task = None
+        if armed:
+            armed[1].cleanup()
+
+    def skip_to(self, target_song):
+        """Skip songs in queue until we reach the target song (best name match or position number)"""
+        matches = self.queue.search(target_song, limit=1)
+        exact = matches and normalize_text(matches[0][1]) == normalize_text(target_song)
+
+        target_index = -1
+        if exact:
+            target_index = matches[0][0]
+        elif target_song.strip().isdecimal() and 0 < int(target_song) <= len(self.queue):
+            target_index = int(target_song) - 1
+        elif matches:
+            target_index = matches[0][0]
+
+        if target_index == -1:
+            return False, "Song not found in queue"
+
+        # Drop the songs before the target
+        song = self.queue[target_index]
+        self._disarm()
+        self.queue.jump_to(target_index)
+        self.refresh_prefetch()
+
+        # Stop current song to trigger next
+        self.skip()
+
+        return True, f"Skipping to: {song}"
+
+    def skip(self):
+        """Stop the current song (or its download) so the next one starts, returns False if there was nothing"""
+        if self.voice_client and (self.voice_client.is_playing() or self.voice_client.is_paused()):
+            self.voice_client.stop()
+            return True
+        if self.loading_query and self.download_pool.detach(self.loading_query, self.guild_id):
+            # play_next gets None for the download and moves on to the next song
+            return True
+        return False
+
+    def stop(self):
+        """Clear the queue, cancel playlist loading and stop playback"""
+        for task in list(self.ingest_tasks):
+            task.cancel()
+        # Before stopping the voice client, or the armed song would start playing
+        self._disarm()
+        self.queue.clear()
+        self.resolver.drop(self.guild_id)
+        self.download_pool.drop_prefetches(self.guild_id)
+        if self.loading_query:
+            # Other guilds waiting on the same download keep it
+            self.download_pool.detach(self.loading_query, self.guild_id)
+
+        if self.voice_client:
+            if self.voice_client.is_playing() or self.voice_client.is_paused():
+                self.voice_client.stop()
+
+        self.state = IDLE
+        self.now_playing = None
+        self.track_ended_at = None
+        self.resume_at = 0
+
+    async def disconnect(self):
+        self.stop()
+        if self.voice_client:
+            await self.voice_client.disconnect()
+            self.voice_client = None
+
+    async def play_next(self, requested_at=None):
+        """Play the next queued song; requested_at is the monotonic time of the command that asked for it"""
+        if self.state != IDLE:
+            self.log("Already processing queue, ignoring duplicate call")
+            return
+
+        if self.queue.empty():
+            self.now_playing = None
+            self.log("Queue empty, stopping playback")
+            return
+
+        try:
+            query = self.queue.pop()
+            start_at, self.resume_at = self.resume_at, 0
+            self.log(f"Got from queue: {query}")
+
+            self.state = LOADING
+            self.touch()
+
+            if not self.is_connected():
+                if not self.voice_channel:
+                    self.log("No voice channel to connect to")
+                    self.state = IDLE
+                    return
+                self.log(f"Connecting to voice channel: {self.voice_channel.name}")
+                self.voice_client = await self.voice_channel.connect()
+
+            if STREAM_MODE and not cached_song(query, self.profile):
+                audio_input, ffmpeg_options = await self._load_stream(query)
+            else:
+                audio_input, ffmpeg_options = await self._load_file(query)
+
+            if not audio_input:
+                self.state = IDLE
+                await self.play_next(requested_at)
+                return
+
+            if not self.is_connected():
+                self.log("Voice client disconnected during download")
+                self.state = IDLE
+                return
+
+            if self.voice_client.is_playing():
+                self.log("Stopping current audio")
+                self.voice_client.stop()
+
+            self.now_playing = query
+            self.state = PLAYING
+
+            self.log(f"Starting playback: {query}")
+
+            try:
+                audio_source = self._open_source(audio_input, ffmpeg_options, start_at)
+                self.log(f"Audio source created for: {query}")
+
+                self.voice_client.play(audio_source, after=lambda error: self._after_playing(query, error))
+                self.playback_started = time.monotonic() - start_at
+                self.paused_at = None
+                self.log(f"Playback started: {query}" + (f" at {start_at:.0f}s" if start_at else ""))
+                self._record_start(requested_at)
+                self._schedule_arm()
+
+                await self.announce(f"Now playing: **{query}**")
+
+            except Exception as play_error:
+                self.log(f"Error starting playback: {play_error}")
+                self.state = IDLE
+                await self.play_next(requested_at)
+
+        except Exception as e:
+            self.log(f"Major error in play_next: {e}")
+            traceback.print_exc()
+            self.state = IDLE
+
+    async def _load_file(self, query):
+        """Download (or find in cache) the song, returns the file and FFmpeg options"""
+        self.log(f"Starting download: {query}")
+        profile = self.profile
+        self.loading_query = self.download_pool.job_key(query, profile)
+        download = self.download_pool.download(query, profile, self.guild_id)
+        # Only now that this song holds its download, or dropping its prefetch would cancel it
+        self.refresh_prefetch()
+        try:
+            mp3_path = await download
+        finally:
+            self.loading_query = None
+        self.log(f"Download result: {mp3_path}")
+
+        mp3_path = self._check_file(mp3_path)
+        if not mp3_path:
+            return None, None
+        return mp3_path, {'options': '-vn'}
+
+    def _check_file(self, mp3_path):
+        """Return the downloaded file if it looks playable, else None"""
+        if not mp3_path:
+            self.log("Download failed (None returned)")
+            return None
+
+        if not os.path.exists(mp3_path):
+            self.log(f"File doesn't exist: {mp3_path}")
+            return None
+
+        file_size = os.path.getsize(mp3_path)
+        self.log(f"File ready: {mp3_path} ({file_size} bytes)")
+
+        if file_size < 1000:
+            self.log(f"File too small, probably corrupted: {file_size} bytes")
+            return None
+
+        return mp3_path
+
+    async def _load_stream(self, query):
+        """Resolve the song's media URL so FFmpeg can start playing it right away"""
+        self.log(f"Resolving stream: {query}")
+        self.loading_query = self.download_pool.stream_key(query)
+        resolve = self.download_pool.resolve(query, self.guild_id)
+        self.refresh_prefetch()
+        try:
+            stream = await resolve
+        finally:
+            self.loading_query = None
+
+        if not stream:
+            self.log(f"Stream resolve failed: {query}")
+            return None, None
+
+        if STREAM_CACHE:
+            # Download in the background too, so the next play of this song comes from the cache
+            self.download_pool.submit(query, self.profile)
+
+        before_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+        headers = ''.join(f"{name}: {value}\r\n" for name, value in stream['http_headers'].items())
+        if headers:
+            before_options += f" -headers {shlex.quote(headers)}"
+
+        return stream['url'], {'before_options': before_options, 'options': '-vn'}
+
+    def _record_start(self, requested_at):
+        now = time.monotonic()
+        if requested_at is not None:
+            FIRST_AUDIO_SECONDS.observe(now - requested_at)
+        elif self.track_ended_at is not None:
+            TRACK_GAP_SECONDS.observe(now - self.track_ended_at)
+        self.track_ended_at = None
+
+    def _open_source(self, audio_input, ffmpeg_options, start_at=0):
+        """Audio source for a file or stream URL, starting start_at seconds in.
+
+        Cached files are played at the gain measured when they were downloaded.
+        Discord ignores the Opus header's output gain, so a file needing a real
+        correction goes through FFmpeg's volume filter instead of passthrough.
+        """
+        gain = track_gain(audio_input)
+        if OPUS_PASSTHROUGH and abs(gain) < PASSTHROUGH_MAX_GAIN_DB and audio_input.endswith(('.opus', '.ogg')):
+            source = OggOpusSource.open(audio_input)
+            if source:
+                if start_at:
+                    source.skip(int(start_at / 0.02))
+                return source
+        ffmpeg_options = dict(ffmpeg_options)
+        if start_at:
+            ffmpeg_options['before_options'] = f"-ss {start_at:.2f} {ffmpeg_options.get('before_options', '')}".strip()
+        if gain:
+            ffmpeg_options['options'] = f"{ffmpeg_options.get('options', '')} -af volume={gain}dB".strip()
+        return FFmpegPCMAudio(audio_input, **ffmpeg_options)
+
+    def _after_playing(self, query, error):
+        # Runs on the voice client's audio thread. Nothing is started from here: VoiceClient.stop()
+        # on the loop could clear a player this thread just started and orphan it.
+        ended_at = time.monotonic()
+        self.log(f"after_playing called for: {query}")
+
+        if error:
+            self.log(f"Playback error: {error}")
+        else:
+            self.log(f"Finished playing: {query}")
+
+        self.loop.call_soon_threadsafe(self._handoff, ended_at)
+
+    def _handoff(self, ended_at):
+        """Start the armed song right after the previous one ended, or load the next one the slow way"""
+        self.track_ended_at = ended_at
+        armed, self.armed = self.armed, None
+        if armed:
+            query, source, generation = armed
+            still_next = generation == self._generation and self.queue.peek(1) == [query]
+            voice_free = self.is_connected() and not (self.voice_client.is_playing() or self.voice_client.is_paused())
+            if still_next and self.state == PLAYING and voice_free:
+                try:
+                    self.voice_client.play(source, after=lambda e: self._after_playing(query, e))
+                except Exception as play_error:
+                    self.log(f"Could not start armed song: {play_error}")
+                    source.cleanup()
+                else:
+                    self._start_armed(query)
+                    return
+            else:
+                # Stopped or skipped around in the meantime, whoever did that owns the state now
+                source.cleanup()
+
+        self.state = IDLE
+        self.touch()
+        asyncio.ensure_future(self.play_next())
+
+    def _start_armed(self, query):
+        started = time.monotonic()
+        TRACK_GAP_SECONDS.observe(started - self.track_ended_at)
+        self.track_ended_at = None
+        self.queue.pop()
+        self.now_playing = query
+        self.playback_started = started
+        self.paused_at = None
+        self.touch()
+        self.log(f"Playback started: {query}")
+        self.refresh_prefetch()
+        asyncio.ensure_future(self.announce(f"Now playing: **{query}**"))
+
+
+class PlayerRegistry:
+    """Lazily creates one GuildPlayer per guild and tears down the ones left idle"""
+
+    def __init__(self, download_pool, resolver):
+        self.download_pool = download_pool
+        self.resolver = resolver
+        self.players = {}
+
+    def get(self, guild_id):
+        player = self.players.get(guild_id)
+        if player is None:
+            player = GuildPlayer(guild_id, self.download_pool, self.resolver)
+            self.players[guild_id] = player
+        player.touch()
+        return player
+
+    def find(self, guild_id):
+        """Return the guild's player without creating one"""
+        return self.players.get(guild_id)
+
+    def __len__(self):
+        return len(self.players)
+
+    def __iter__(self):
+        return iter(list(self.players.values()))
+
+    async def reap_idle(self, timeout=PLAYER_IDLE_TIMEOUT):
+        """Disconnect and forget players nobody has used for timeout seconds"""
+        for guild_id, player in list(self.players.items()):
+            if not player.is_idle(timeout):
+                continue
+            # Removed before awaiting, so a command arriving meanwhile gets a fresh player
+            # instead of this one being dropped while it's in use
+            del self.players[guild_id]
+            try:
+                await player.disconnect()
+            except Exception as e:
+                player.log(f"Error tearing down idle player: {e}")
+            player.log("Removed idle player")
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import asyncio
+
+# Where each guild's queue and playback position are saved for restarts (empty = don't save)
+SESSION_DIR = os.getenv("SESSION_DIR", "sessions")
+# How often playback positions are saved, queues are only rewritten when they change
+SESSION_SAVE_INTERVAL = int(os.getenv("SESSION_SAVE_INTERVAL", "15"))
+# Sessions older than this are not restored
+SESSION_MAX_AGE = 6 * 3600
+
+
+def _write_json(path, data):
+    # Written to a temp file first so a crash mid-write never leaves a broken session
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class SessionStore:
+    """Saves what every guild is playing so a restarted bot can pick up where it left off.
+
+    Each guild has two files: <guild>.queue.json with the current song and the
+    queue, rewritten only when the queue changes, and <guild>.json with the
+    voice channel and playback position, rewritten on every save.
+    """
+
+    def __init__(self, folder=SESSION_DIR):
+        self.folder = folder
+        self._saved = {}  # guild id -> (queue version, now playing) last written
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def _paths(self, guild_id):
+        base = os.path.join(self.folder, str(guild_id))
+        return base + ".json", base + ".queue.json"
+
+    async def save(self, players):
+        """Write the sessions of players that are playing, drop those that stopped"""
+        if not self.folder:
+            return
+        for player in players:
+            guild_id = player.guild_id
+            if not player.voice_channel or not (player.now_playing or player.queue):
+                if self._saved.pop(guild_id, None) is not None:
+                    await asyncio.to_thread(self.forget, guild_id)
+                continue
+
+            state = {
+                'guild_id': guild_id,
+                'voice_channel_id': player.voice_channel.id,
+                'text_channel_id': player.text_channel.id if player.text_channel else None,
+                'now_playing': player.now_playing,
+                'position': round(player.position(), 2),
+                'saved_at': time.time(),
+            }
+            version = (player.queue.version, player.now_playing)
+            queue = None
+            if self._saved.get(guild_id) != version:
+                # Copied here on the loop, serialized and written on a worker thread
+                queue = {'now_playing': player.now_playing, 'queue': player.queue.to_list()}
+            try:
+                await asyncio.to_thread(self._write, guild_id, state, queue)
+            except OSError as e:
+                player.log(f"Could not save session: {e}")
+                continue
+            self._saved[guild_id] = version
+
+    def _write(self, guild_id, state, queue):
+        state_path, queue_path = self._paths(guild_id)
+        if queue is not None:
+            _write_json(queue_path, queue)
+        _write_json(state_path, state)
+
+    def forget(self, guild_id):
+        for path in self._paths(guild_id):
+            _remove(path)
+
+    def load(self):
+        """All saved sessions recent enough to restore, with their queues"""
+        if not self.folder:
+            return []
+        sessions = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(".json") or name.endswith(".queue.json"):
+                continue
+            guild_id = name[:-len(".json")]
+            state_path, queue_path = self._paths(guild_id)
+            try:
+                with open(state_path, encoding='utf-8') as f:
+                    state = json.load(f)
+                with open(queue_path, encoding='utf-8') as f:
+                    queue = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Skipping unreadable session {name}: {e}")
+                continue
+            if time.time() - state.get('saved_at', 0) > SESSION_MAX_AGE:
+                self.forget(guild_id)
+                continue
+            # The position only belongs to the song the queue file says was playing
+            if state.get('now_playing') != queue.get('now_playing'):
+                state['position'] = 0
+            state['now_playing'] = queue.get('now_playing')
+            state['queue'] = queue.get('queue', [])
+            sessions.append(state)
+        return sessions
@@ -0,0 +1,184 @@
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from metrics import SPOTIFY_THROTTLED, SPOTIFY_WAIT_SECONDS
+
+# Spotify API requests started per second at most, shared by every guild
+SPOTIFY_RATE = float(os.getenv("SPOTIFY_RATE", "10"))
+# Requests that may go out at once after a quiet period
+SPOTIFY_BURST = int(os.getenv("SPOTIFY_BURST", "20"))
+# How many Spotify requests (e.g. playlist pages) are in flight at the same time
+SPOTIFY_FETCH_WORKERS = int(os.getenv("SPOTIFY_FETCH_WORKERS", "8"))
+# Times a request is retried after a 429 or a server error
+MAX_RETRIES = 4
+# Wait after a 429 that didn't say how long to back off
+DEFAULT_RETRY_AFTER = 5
+
+# Priority lanes, lower goes first
+INTERACTIVE = 0  # someone is waiting on the answer: playlist info, first pages, /stats
+BACKGROUND = 1   # the rest of a playlist being queued while music already plays
+
+
+class _Job:
+    __slots__ = ('func', 'args', 'kwargs', 'priority', 'owner', 'future', 'queued_at', 'attempts')
+
+    def __init__(self, func, args, kwargs, priority, owner):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.owner = owner
+        self.future = Future()
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+
+class SpotifyScheduler:
+    """Queues Spotify requests and decides which one is sent next.
+
+    Requests wait in two lanes; the interactive lane always goes first. Within
+    a lane, guilds take turns (round robin), so one guild importing a huge
+    playlist can't starve the others. A token bucket caps the overall rate,
+    and a 429 pauses every lane for the Retry-After Spotify asked for.
+
+    Every queued request stays in its lane until a worker thread picks it, so
+    requests submitted later with a higher priority or for another guild can
+    still overtake it.
+    """
+
+    def __init__(self, rate=SPOTIFY_RATE, burst=SPOTIFY_BURST, workers=SPOTIFY_FETCH_WORKERS):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.workers = max(1, workers)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0
+        self._lanes = {INTERACTIVE: OrderedDict(), BACKGROUND: OrderedDict()}  # owner -> queued jobs
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, func, *args, priority=INTERACTIVE, owner=None, **kwargs):
+        """Queue func(*args, **kwargs) and return a concurrent Future for its result.
+
+        Cancelling the future before a worker picks the request up drops it.
+        """
+        job = _Job(func, args, kwargs, priority, owner)
+        with self._cond:
+            self._start_workers()
+            self._lanes[priority].setdefault(owner, deque()).append(job)
+            self._cond.notify()
+        return job.future
+
+    def call(self, func, *args, priority=INTERACTIVE, owner=None, **kwargs):
+        """Run func(*args, **kwargs) once the scheduler gets to it and return its result"""
+        return self.submit(func, *args, priority=priority, owner=owner, **kwargs).result()
+
+    def throttle(self, seconds):
+        """Hold every request back for seconds, after Spotify answered 429"""
+        SPOTIFY_THROTTLED.inc()
+        print(f"⏳ Spotify rate limit hit, pausing requests for {seconds:.0f}s")
+        with self._cond:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0
+            self._cond.notify_all()
+
+    def pending(self):
+        with self._cond:
+            return sum(len(jobs) for lane in self._lanes.values() for jobs in lane.values())
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"spotify-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._take()
+            try:
+                result = job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                if not self._retry(job, e):
+                    job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+
+    def _take(self):
+        """Wait for the next job it's time to send"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                job = self._next_job()
+                if job is None:
+                    self._cond.wait()
+                    continue
+                if job.attempts == 0 and job.future.cancelled():
+                    self._pop(job)
+                    continue
+                wait = self._blocked_until - now
+                if self._tokens < 1:
+                    wait = max(wait, (1 - self._tokens) / self.rate)
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+                self._pop(job)
+                if job.attempts == 0 and not job.future.set_running_or_notify_cancel():
+                    continue
+                self._tokens -= 1
+                break
+        if job.attempts == 0:
+            lane = "interactive" if job.priority == INTERACTIVE else "background"
+            SPOTIFY_WAIT_SECONDS.observe(now - job.queued_at, lane=lane)
+        return job
+
+    def _retry(self, job, error):
+        """Queue job again after a 429 or server error, returns False if it shouldn't be retried"""
+        status = getattr(error, 'http_status', None)
+        if job.attempts >= MAX_RETRIES or not (status == 429 or (status or 0) >= 500):
+            return False
+        job.attempts += 1
+        if status == 429:
+            self.throttle(self._retry_after(error))
+        else:
+            time.sleep(min(2 ** job.attempts, 30))
+        with self._cond:
+            # Back at the front of the queue, it was next before it failed
+            lane = self._lanes[job.priority]
+            lane.setdefault(job.owner, deque()).appendleft(job)
+            lane.move_to_end(job.owner, last=False)
+            self._cond.notify()
+        return True
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _next_job(self):
+        for priority in (INTERACTIVE, BACKGROUND):
+            lane = self._lanes[priority]
+            if lane:
+                return next(iter(lane.values()))[0]
+        return None
+
+    def _pop(self, job):
+        # The owner goes to the back of its lane so the other guilds get a turn first
+        lane = self._lanes[job.priority]
+        jobs = lane.pop(job.owner)
+        jobs.popleft()
+        if jobs:
+            lane[job.owner] = jobs
+
+    @staticmethod
+    def _retry_after(error):
+        headers = getattr(error, 'headers', None) or {}
+        try:
+            return max(1.0, float(headers.get('Retry-After', DEFAULT_RETRY_AFTER)))
+        except (TypeError, ValueError):
+            return DEFAULT_RETRY_AFTER
+
+
+scheduler = SpotifyScheduler()
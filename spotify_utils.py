@@ -1,21 +1,112 @@
 import os
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+import json
+import asyncio
+import threading
+from collections import OrderedDict
+from metrics import SPOTIFY_REQUESTS
+from spotify_scheduler import scheduler, INTERACTIVE, BACKGROUND, SPOTIFY_FETCH_WORKERS
+
+# Page size Spotify allows for playlist_tracks
+PAGE_SIZE = 100
+TOKEN_CACHE_PATH = ".cache"
+# Parsed playlists are kept here between restarts (set to an empty string to keep them in memory only)
+PLAYLIST_CACHE_DIR = os.getenv("PLAYLIST_CACHE_DIR", "playlists")
+# How many parsed playlists to keep in memory
+PLAYLIST_CACHE_SIZE = 256
+
+_client = None
+_client_lock = threading.Lock()
+_playlist_cache = OrderedDict()  # playlist id -> parsed playlist, see load_playlist
+_playlist_cache_lock = threading.Lock()
 
 # Initialize Spotify client using environment variables
 # (These will be set by the main bot file after secure credential collection)
 def get_spotify_client():
-    """Get Spotify client using credentials from environment variables"""
-    client_id = os.getenv("SPOTIFY_CLIENT_ID")
-    client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
-    
-    if not client_id or not client_secret:
-        raise ValueError("Spotify credentials not found in environment variables. Make sure the main bot has set them.")
-    
-    return spotipy.Spotify(auth_manager=SpotifyClientCredentials(
-        client_id=client_id,
-        client_secret=client_secret
-    ))
+    """Get the shared Spotify client, created on first use from environment variables.
+
+    The client keeps one pooled HTTP session and reuses its access token
+    (persisted in .cache) until it expires, instead of re-authenticating on
+    every command.
+    """
+    global _client
+
+    if _client is not None:
+        return _client
+
+    with _client_lock:
+        if _client is None:
+            client_id = os.getenv("SPOTIFY_CLIENT_ID")
+            client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
+            
+            if not client_id or not client_secret:
+                raise ValueError("Spotify credentials not found in environment variables. Make sure the main bot has set them.")
+
+            # Imported here so the bot starts without loading spotipy and requests
+            import requests
+            import spotipy
+            from spotipy.cache_handler import CacheFileHandler
+            from spotipy.oauth2 import SpotifyClientCredentials
+
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=SPOTIFY_FETCH_WORKERS)
+            session.mount("https://", adapter)
+
+            _client = spotipy.Spotify(
+                auth_manager=SpotifyClientCredentials(
+                    client_id=client_id,
+                    client_secret=client_secret,
+                    cache_handler=CacheFileHandler(cache_path=TOKEN_CACHE_PATH),
+                ),
+                requests_session=session,
+            )
+    return _client
+
+
+def _send(endpoint, *args, **kwargs):
+    SPOTIFY_REQUESTS.inc(endpoint=endpoint)
+    return getattr(get_spotify_client(), endpoint)(*args, **kwargs)
+
+
+def spotify_submit(endpoint, *args, priority=INTERACTIVE, owner=None, **kwargs):
+    """Queue a call to a method of the shared client with the request scheduler, returns its future.
+
+    owner (the guild id) is what the scheduler takes turns between, priority
+    picks the lane; rate limited requests are retried after Spotify's Retry-After.
+    """
+    return scheduler.submit(_send, endpoint, *args, priority=priority, owner=owner, **kwargs)
+
+
+def spotify_call(endpoint, *args, priority=INTERACTIVE, owner=None, **kwargs):
+    """Like spotify_submit, waiting for the result"""
+    return spotify_submit(endpoint, *args, priority=priority, owner=owner, **kwargs).result()
+
+
+def fetch_playlist_pages(playlist_id, owner=None, priority=BACKGROUND):
+    """Yield the item pages of a playlist in order, the pages after the first one fetched in parallel.
+
+    The first page is always fetched as interactive, someone is waiting for
+    it; the others go in the priority lane. They wait in the scheduler, not
+    a thread pool queue, so other guilds' requests still get their turns.
+    """
+    first = spotify_call('playlist_tracks', playlist_id, limit=PAGE_SIZE, owner=owner)
+    yield first['items']
+
+    # The first page tells us the total, so the remaining offsets are known up front
+    offsets = range(len(first['items']), first['total'], PAGE_SIZE)
+    futures = [
+        spotify_submit(
+            'playlist_tracks', playlist_id,
+            limit=PAGE_SIZE, offset=offset, priority=priority, owner=owner,
+        )
+        for offset in offsets
+    ]
+    try:
+        for future in futures:
+            yield future.result()['items']
+    finally:
+        # Stop fetching pages nobody will read (e.g. the import was cancelled)
+        for future in futures:
+            future.cancel()
 
 
 def extract_playlist_id(url):
@@ -28,33 +119,149 @@ def extract_playlist_id(url):
         return url  # Assume it's already a playlist ID
 
 
-def get_tracks_from_playlist(url):
-    """Get all tracks from a Spotify playlist (handles pagination)"""
+def parse_track(track):
+    """Keep just the fields the bot uses from a Spotify track object"""
+    return {
+        'name': track['name'],
+        'artist': track['artists'][0]['name'] if track['artists'] else 'Unknown Artist',
+        'duration_ms': track.get('duration_ms') or 0,
+        'isrc': (track.get('external_ids') or {}).get('isrc'),
+    }
+
+
+def _playlist_cache_path(playlist_id):
+    return os.path.join(PLAYLIST_CACHE_DIR, f"{playlist_id}.json")
+
+
+def _cached_playlist(playlist_id):
+    with _playlist_cache_lock:
+        if playlist_id in _playlist_cache:
+            _playlist_cache.move_to_end(playlist_id)
+            return _playlist_cache[playlist_id]
+
+    if not PLAYLIST_CACHE_DIR:
+        return None
     try:
-        sp = get_spotify_client()
-        playlist_id = extract_playlist_id(url)
-        tracks = []
-        
-        # Get playlist info first
-        playlist = sp.playlist(playlist_id)
-        print(f"📋 Loading playlist: {playlist['name']}")
-        
-        # Get all tracks with pagination
-        results = sp.playlist_tracks(playlist_id)
-        
-        while results:
-            for item in results['items']:
-                if item['track'] and item['track']['name']:  # Check if track exists
-                    track = item['track']
-                    name = track['name']
-                    artist = track['artists'][0]['name'] if track['artists'] else 'Unknown Artist'
-                    tracks.append(f"{name} - {artist}")
-            
-            # Check if there are more tracks (pagination)
-            if results['next']:
-                results = sp.next(results)
-            else:
+        with open(_playlist_cache_path(playlist_id), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _store_playlist(playlist_id, playlist):
+    with _playlist_cache_lock:
+        _playlist_cache[playlist_id] = playlist
+        _playlist_cache.move_to_end(playlist_id)
+        while len(_playlist_cache) > PLAYLIST_CACHE_SIZE:
+            _playlist_cache.popitem(last=False)
+
+    if not PLAYLIST_CACHE_DIR:
+        return
+    try:
+        os.makedirs(PLAYLIST_CACHE_DIR, exist_ok=True)
+        path = _playlist_cache_path(playlist_id)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(playlist, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print(f"❌ Could not save playlist cache: {e}")
+
+
+def _open_playlist(url, owner=None):
+    """Return (playlist id, name/snapshot info, cached playlist if still current)"""
+    playlist_id = extract_playlist_id(url)
+
+    info = spotify_call('playlist', playlist_id, fields='name,snapshot_id', owner=owner)
+    cached = _cached_playlist(playlist_id)
+    if cached and cached['snapshot_id'] == info['snapshot_id']:
+        print(f"📋 Playlist unchanged, using cache: {info['name']}")
+        if playlist_id not in _playlist_cache:
+            _store_playlist(playlist_id, cached)
+        return playlist_id, info, cached
+
+    print(f"📋 Loading playlist: {info['name']}")
+    return playlist_id, info, None
+
+
+def iter_playlist_pages(url, owner=None):
+    """Yield a playlist's parsed tracks page by page, storing the full playlist once done"""
+    playlist_id, info, cached = _open_playlist(url, owner)
+    if cached:
+        yield cached['tracks']
+        return
+
+    tracks = []
+    for items in fetch_playlist_pages(playlist_id, owner):
+        page = [
+            parse_track(item['track'])
+            for item in items
+            if item['track'] and item['track']['name']  # Check if track exists
+        ]
+        tracks.extend(page)
+        yield page
+
+    _store_playlist(playlist_id, {
+        'id': playlist_id,
+        'name': info['name'],
+        'snapshot_id': info['snapshot_id'],
+        'tracks': tracks,
+    })
+
+
+async def stream_playlist(url, owner=None):
+    """Async version of iter_playlist_pages, each page is fetched on a worker thread"""
+    pages = iter_playlist_pages(url, owner)
+    try:
+        while True:
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
                 break
+            yield page
+    finally:
+        try:
+            pages.close()
+        except ValueError:
+            # Still running on its thread after a cancel; it finishes its current page and is dropped
+            pass
+
+
+def load_playlist(url, owner=None):
+    """Get a playlist's name and parsed tracks, shared by /playlist and /stats.
+
+    Parsed playlists are cached by id and checked against Spotify's
+    snapshot_id, so an unchanged playlist costs a single small request.
+    Every page is fetched in the interactive lane since the caller waits for all of them.
+    """
+    playlist_id, info, cached = _open_playlist(url, owner)
+    if cached:
+        return cached
+
+    tracks = [
+        parse_track(item['track'])
+        for items in fetch_playlist_pages(playlist_id, owner, priority=INTERACTIVE)
+        for item in items
+        if item['track'] and item['track']['name']  # Check if track exists
+    ]
+    playlist = {
+        'id': playlist_id,
+        'name': info['name'],
+        'snapshot_id': info['snapshot_id'],
+        'tracks': tracks,
+    }
+    _store_playlist(playlist_id, playlist)
+    return playlist
+
+
+def track_query(track):
+    """The search text queued for a parsed Spotify track"""
+    return f"{track['name']} - {track['artist']}"
+
+
+def get_tracks_from_playlist(url, owner=None):
+    """Get all tracks from a Spotify playlist (handles pagination)"""
+    try:
+        playlist = load_playlist(url, owner)
+        tracks = [track_query(track) for track in playlist['tracks']]
         
         print(f"✅ Found {len(tracks)} tracks in playlist")
         return tracks
@@ -67,46 +274,24 @@ def get_tracks_from_playlist(url):
         return []
 
 
-def get_playlist_stats(url):
+def get_playlist_stats(url, owner=None):
     """Get statistics for a Spotify playlist (handles pagination)"""
     try:
-        sp = get_spotify_client()
-        playlist_id = extract_playlist_id(url)
+        playlist = load_playlist(url, owner)
         
-        # Get playlist info
-        playlist = sp.playlist(playlist_id)
-        playlist_name = playlist['name']
-        
-        tracks = []
         total_duration = 0
         artists = set()
         
-        # Get all tracks with pagination
-        results = sp.playlist_tracks(playlist_id)
-        
-        while results:
-            for item in results['items']:
-                if item['track'] and item['track']['name']:  # Check if track exists
-                    track = item['track']
-                    tracks.append(track)
-                    
-                    # Add duration (convert from ms to minutes)
-                    if track['duration_ms']:
-                        total_duration += track['duration_ms']
-                    
-                    # Collect unique artists
-                    if track['artists']:
-                        artists.add(track['artists'][0]['name'])
+        for track in playlist['tracks']:
+            # Add duration (convert from ms to minutes)
+            total_duration += track['duration_ms']
             
-            # Check if there are more tracks (pagination)
-            if results['next']:
-                results = sp.next(results)
-            else:
-                break
+            # Collect unique artists
+            artists.add(track['artist'])
         
         return {
-            'name': playlist_name,
-            'total': len(tracks),
+            'name': playlist['name'],
+            'total': len(playlist['tracks']),
             'duration_min': total_duration // 60000,  # Convert ms to minutes
             'artists': list(artists)
         }
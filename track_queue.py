@@ -0,0 +1,254 @@
+import re
+import asyncio
+import unicodedata
+from bisect import bisect_left
+from collections import Counter
+from itertools import islice
+
+
+def normalize_text(text):
+    """Casefold and strip punctuation so "Song - Artist" matches "song artist" """
+    text = unicodedata.normalize('NFKC', text).casefold()
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+def trigrams(text):
+    """Character trigrams of each word, padded so short words and word starts count too"""
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrackQueue:
+    """FIFO of upcoming tracks with O(1) push/pop/len and cheap peeking.
+
+    Items live in a list with a moving head index, so reading the queue for
+    /queue or /skipto never has to drain and refill it, and jumping forward to
+    a position just moves the head.
+
+    A trigram index over the queued tracks is kept up to date as tracks come
+    and go, so search() only looks at tracks sharing parts of words with the
+    query instead of scanning the whole queue. New tracks are indexed in the
+    background a chunk at a time, so queueing a huge playlist doesn't block
+    the event loop; search() indexes whatever is still left first.
+    """
+
+    # Compact the backing list once this many popped slots pile up at the front
+    COMPACT_AFTER = 1024
+    # Share of the query's trigrams a track needs to count as a search match
+    MIN_SIMILARITY = 0.5
+    # Tracks indexed before the background indexer lets other tasks run
+    INDEX_CHUNK = 256
+
+    def __init__(self):
+        self._items = []
+        self._ids = []  # increasing id of each item, parallel to _items
+        self._head = 0
+        self._next_id = 0
+        self._grams = {}  # trigram -> ids of the tracks containing it
+        self._texts = {}  # id -> normalized track text
+        self._indexed_until = 0  # tracks with an id below this are indexed
+        self._index_task = None
+        self._not_empty = asyncio.Event()
+        self.version = 0  # bumped on every change, lets callers skip re-saving an unchanged queue
+
+    def __len__(self):
+        return len(self._items) - self._head
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        return islice(self._items, self._head, None)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.slice(index.start or 0, index.stop)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("queue index out of range")
+        return self._items[self._head + index]
+
+    def empty(self):
+        return len(self) == 0
+
+    def qsize(self):
+        return len(self)
+
+    def put(self, item):
+        self._items.append(item)
+        self._ids.append(self._next_id)
+        self._next_id += 1
+        self.version += 1
+        self._not_empty.set()
+        self._schedule_indexing()
+        return len(self)
+
+    def extend(self, items):
+        items = list(items)
+        self._items.extend(items)
+        self._ids.extend(range(self._next_id, self._next_id + len(items)))
+        self._next_id += len(items)
+        self.version += 1
+        if self:
+            self._not_empty.set()
+        self._schedule_indexing()
+        return len(self)
+
+    def pop(self):
+        """Remove and return the next track, raises IndexError if the queue is empty"""
+        if not self:
+            raise IndexError("pop from empty queue")
+        item = self._items[self._head]
+        self._unindex(self._ids[self._head])
+        self._items[self._head] = None
+        self._head += 1
+        self.version += 1
+        self._after_removal()
+        return item
+
+    async def get(self):
+        """Wait until a track is queued, then pop it"""
+        while not self:
+            await self._not_empty.wait()
+        return self.pop()
+
+    def peek(self, count=1):
+        """Return the next count tracks without removing them"""
+        return self.slice(0, count)
+
+    def slice(self, start, stop=None):
+        start = self._head + max(start, 0)
+        stop = len(self._items) if stop is None else min(self._head + stop, len(self._items))
+        return self._items[start:stop]
+
+    def to_list(self):
+        return self._items[self._head:]
+
+    def remove_at(self, index):
+        """Remove and return the track at position index (0 = next up)"""
+        item = self[index]
+        if index < 0:
+            index += len(self)
+        if index == 0:
+            return self.pop()
+        self._unindex(self._ids[self._head + index])
+        del self._items[self._head + index]
+        del self._ids[self._head + index]
+        self.version += 1
+        self._after_removal()
+        return item
+
+    def jump_to(self, index):
+        """Drop every track before position index so it becomes the next one up"""
+        if not 0 <= index < len(self):
+            raise IndexError("queue index out of range")
+        for i in range(self._head, self._head + index):
+            self._unindex(self._ids[i])
+            self._items[i] = None
+        self._head += index
+        self.version += 1
+        self._after_removal()
+
+    def clear(self):
+        self._items = []
+        self._ids = []
+        self._head = 0
+        self._grams = {}
+        self._texts = {}
+        self._indexed_until = self._next_id
+        self.version += 1
+        self._not_empty.clear()
+
+    def search(self, query, limit=10):
+        """Best matching queued tracks for query as (position, track), best first.
+
+        Exact matches rank first, then tracks containing the query, then tracks
+        sharing the most trigrams with it; ties go to the track coming up sooner.
+        """
+        text = normalize_text(query)
+        query_grams = trigrams(text)
+        if not query_grams:
+            return []
+        self._index_pending()
+
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(self._grams.get(gram, ()))
+
+        needed = len(query_grams) * self.MIN_SIMILARITY
+        ranked = []
+        for item_id, count in shared.items():
+            if count < needed:
+                continue
+            track_text = self._texts[item_id]
+            if track_text == text:
+                rank = 0
+            elif text in track_text:
+                rank = 1
+            else:
+                rank = 2
+            ranked.append((rank, -count, item_id))
+
+        ranked.sort()
+        results = []
+        for _rank, _count, item_id in ranked[:limit]:
+            position = self._position(item_id)
+            results.append((position, self._items[self._head + position]))
+        return results
+
+    def _position(self, item_id):
+        return bisect_left(self._ids, item_id, self._head) - self._head
+
+    def _schedule_indexing(self):
+        if self._index_task and not self._index_task.done():
+            return
+        try:
+            self._index_task = asyncio.get_running_loop().create_task(self._index_in_background())
+        except RuntimeError:
+            # No event loop, search() indexes everything when it's needed
+            pass
+
+    async def _index_in_background(self):
+        while self._index_pending(self.INDEX_CHUNK):
+            await asyncio.sleep(0)
+
+    def _index_pending(self, limit=None):
+        """Index up to limit tracks not indexed yet, returns True if some are still left"""
+        start = bisect_left(self._ids, self._indexed_until, self._head)
+        stop = len(self._items) if limit is None else min(start + limit, len(self._items))
+        for i in range(start, stop):
+            self._index(self._ids[i], self._items[i])
+        if stop < len(self._items):
+            self._indexed_until = self._ids[stop]
+            return True
+        self._indexed_until = self._next_id
+        return False
+
+    def _index(self, item_id, item):
+        text = normalize_text(str(item))
+        self._texts[item_id] = text
+        for gram in trigrams(text):
+            self._grams.setdefault(gram, set()).add(item_id)
+
+    def _unindex(self, item_id):
+        text = self._texts.pop(item_id, None)
+        if text is None:
+            return
+        for gram in trigrams(text):
+            ids = self._grams.get(gram)
+            if ids is not None:
+                ids.discard(item_id)
+                if not ids:
+                    del self._grams[gram]
+
+    def _after_removal(self):
+        if not self:
+            self.clear()
+        elif self._head >= self.COMPACT_AFTER and self._head * 2 >= len(self._items):
+            del self._items[:self._head]
+            del self._ids[:self._head]
+            self._head = 0